@@ -53,7 +53,7 @@ class Key:
         return str_
 
 
-class Schema(abc.ABCMeta):
+class Schema(metaclass=abc.ABCMeta):
     '''A Database schema
 
     :param granularity: Record granularity
@@ -9,6 +9,68 @@
 .. moduleauthor:: Tiago Antao <tra@popgen.net>
 
 '''
+import numpy
+
+from genomics import GenomicsException
+
+
+def _get_code_table(marker_len, max_allele):
+    '''Zero padded digits (uint8 ASCII codes) of each allele up to max.'''
+    alleles = numpy.arange(max_allele + 1)[:, None]
+    powers = 10 ** numpy.arange(marker_len - 1, -1, -1)[None, :]
+    return ((alleles // powers) % 10 + ord('0')).astype(numpy.uint8)
+
+
+def write_genepop(w, genotypes, pop_indexes, names, loci_list,
+                  comment_line='', marker_len=None, pops=None,
+                  batch_size=10000):
+    '''Writes genotype arrays as a Genepop file.
+
+    :param w: write handle for the Genepop file
+    :param genotypes: (individuals x loci x ploidy) alleles (0 is missing)
+    :param pop_indexes: population of each individual
+    :param names: name of each individual
+    :param loci_list: loci names
+    :param comment_line: first line of the file
+    :param marker_len: digits per allele (default: 2 if all alleles are
+        below 100, else 3)
+    :param pops: populations to write, in order (default: all, sorted)
+
+    The arguments are as returned by
+    :py:func:`genomics.popgen.genepop.parser.read_array`. Rows are
+    formatted a batch of batch_size individuals at a time, with a table
+    of pre-formatted allele codes.
+    '''
+    genotypes = numpy.asarray(genotypes)
+    pop_indexes = numpy.asarray(pop_indexes)
+    names = numpy.asarray(names)
+    max_allele = int(genotypes.max()) if genotypes.size > 0 else 0
+    if marker_len is None:
+        marker_len = 2 if max_allele < 100 else 3
+    if max_allele >= 10 ** marker_len:
+        raise GenomicsException('Allele %d has more than %d digits' %
+                                (max_allele, marker_len))
+    table = _get_code_table(marker_len, max_allele)
+    if pops is None:
+        pops = numpy.unique(pop_indexes)
+    w.write(comment_line + '\n')
+    for locus in loci_list:
+        w.write(locus + '\n')
+    ploidy = genotypes.shape[2] if genotypes.ndim == 3 else 1
+    for pop in pops:
+        w.write('POP\n')
+        indivs = numpy.flatnonzero(pop_indexes == pop)
+        for start in range(0, len(indivs), batch_size):
+            block = indivs[start:start + batch_size]
+            codes = table[genotypes[block]].reshape(
+                len(block), -1, ploidy * marker_len)
+            rows = numpy.empty((len(block), codes.shape[1],
+                                1 + ploidy * marker_len), dtype=numpy.uint8)
+            rows[:, :, 0] = ord(' ')
+            rows[:, :, 1:] = codes
+            rows = rows.reshape(len(block), -1)
+            for name, row in zip(names[block], rows):
+                w.write('%s,%s\n' % (name, row.tobytes().decode()))
 
 
 def to_smartpca(gp_f, ind_w, snp_w, geno_w):
@@ -28,7 +90,7 @@ def to_smartpca(gp_f, ind_w, snp_w, geno_w):
     alleles_loci = [set() for x in gph.loci_list]
 
     pop_names = {}
-    for rec in next(gph):
+    for rec in gph:
         if rec == ():
             pop += 1
             continue
@@ -8,6 +8,12 @@
 
 .. moduleauthor:: Tiago Antao <tra@popgen.net>
 '''
+import bisect
+import os
+
+import numpy
+
+from genomics import GenomicsException
 
 
 def _get_indiv(line):
@@ -28,6 +34,33 @@ def _get_indiv(line):
     return indiv_name, allele_list, marker_len
 
 
+def _decode_indivs(lines, marker_len, nloci):
+    '''Decodes individual lines into names and an uint16 allele array.
+
+    All markers are fixed width, so the digits of all lines are
+    converted at once to an (individuals x loci x ploidy) array.
+    '''
+    names = []
+    markers = []
+    for line in lines:
+        indiv_name, marker_line = line.split(',', 1)
+        names.append(indiv_name)
+        markers.append(''.join(marker_line.split()))
+    width = len(markers[0])
+    if any(len(marker) != width for marker in markers) or \
+            width % (nloci * marker_len) != 0:
+        raise GenomicsException('Individuals with wrong number of alleles')
+    ploidy = width // (nloci * marker_len)
+    digits = numpy.frombuffer(''.join(markers).encode(), dtype=numpy.uint8)
+    digits = digits.reshape(len(lines), nloci, ploidy, marker_len)
+    if numpy.any((digits < ord('0')) | (digits > ord('9'))):
+        raise GenomicsException('Alleles are not numeric')
+    alleles = numpy.zeros(digits.shape[:3], dtype=numpy.uint16)
+    for i in range(marker_len):
+        alleles = alleles * 10 + (digits[:, :, :, i] - ord('0'))
+    return names, alleles
+
+
 def read(handle):
     """Parses a handle containing a Genepop file.
 
@@ -55,6 +88,31 @@ def read(handle):
     return record
 
 
+def read_array(handle, batch_size=10000):
+    """Reads all the genotypes of a Genepop file into arrays.
+
+       Returns the record (with comment_line, loci_list and marker_len),
+       an (individuals x loci x ploidy) uint16 array of alleles (0 is
+       missing), the population index (from 0) of each individual and
+       the names of the individuals.
+    """
+    record = read(handle)
+    genotypes = []
+    pop_indexes = []
+    names = []
+    for pop, batch_names, alleles in record.iter_batches(batch_size):
+        genotypes.append(alleles)
+        pop_indexes.extend([pop] * len(batch_names))
+        names.extend(batch_names)
+    if len(genotypes) == 0:
+        genotypes = numpy.zeros((0, len(record.loci_list), 2),
+                                dtype=numpy.uint16)
+    else:
+        genotypes = numpy.concatenate(genotypes)
+    return (record, genotypes, numpy.array(pop_indexes, dtype=numpy.int64),
+            numpy.array(names))
+
+
 class Record(object):
     '''Holds information from a GenePop record.
 
@@ -69,7 +127,8 @@ class Record(object):
     The generator will only work once. If you want to read a handle
     twice you have to re-open it!
 
-    The object will be a generator for the data.
+    The object is an iterator over the data (iter_batches reads it
+    in blocks of individuals).
 
     data can either be:
         () - an empty tuple - marking a new population or
@@ -91,22 +150,270 @@ class Record(object):
     def __iter__(self):
         return self
 
+    def _next_line(self):
+        '''Next non empty line (None at the end).'''
+        while len(self.stack) > 0:
+            line = self.stack.pop(0).rstrip()
+            if line != '':
+                return line
+        for line in self.handle:
+            line = line.rstrip()
+            if line != '':
+                return line
+        return None
+
     def __next__(self):
-        for handle in [self.stack, self.handle]:
-            for line in handle:
-                line = line.rstrip()
-                if line.upper() == 'POP':
-                    yield ()
+        line = self._next_line()
+        if line is None:
+            raise StopIteration()
+        if line.upper() == 'POP':
+            return ()
+        indiv_name, allele_list, marker_len = _get_indiv(line)
+        clean_list = []
+        for locus in allele_list:
+            mk_real = []
+            for al in locus:
+                if al == 0:
+                    mk_real.append(None)
                 else:
-                    indiv_name, allele_list, marker_len = _get_indiv(line)
-                    clean_list = []
-                    for locus in allele_list:
-                        mk_real = []
-                        for al in locus:
-                            if al == 0:
-                                mk_real.append(None)
-                            else:
-                                mk_real.append(al)
-                        clean_list.append(tuple(mk_real))
-                    yield indiv_name, clean_list
-        raise StopIteration()
+                    mk_real.append(al)
+            clean_list.append(tuple(mk_real))
+        return indiv_name, clean_list
+
+    def iter_batches(self, batch_size=1000):
+        '''Iterates over blocks of individuals of the same population.
+
+        Yields the population index (starting at 0), the names of the
+        individuals and an (individuals x loci x ploidy) uint16 array
+        with the alleles (0 is missing). Blocks have at most
+        batch_size individuals and never span populations.
+
+        This consumes the same stream as iterating over the record.
+        '''
+        pop = -1
+        lines = []
+        while True:
+            line = self._next_line()
+            if line is None or line.upper() == 'POP' or \
+                    len(lines) == batch_size:
+                if len(lines) > 0:
+                    names, alleles = _decode_indivs(
+                        lines, self.marker_len, len(self.loci_list))
+                    yield pop, names, alleles
+                lines = []
+            if line is None:
+                return
+            if line.upper() == 'POP':
+                pop += 1
+                continue
+            lines.append(line)
+
+
+class GenepopIndex(object):
+    '''Sidecar index of a Genepop file.
+
+    Members:
+    size               Size of the indexed file.
+
+    mtime              Modification time (ns) of the indexed file.
+
+    every              Every how many individuals an offset is kept.
+
+    nindivs            Number of individuals.
+
+    pops               (offset of the POP line, index of its first
+                       individual) per population.
+
+    checkpoints        (individual index, population, offset) of every
+                       every-th individual.
+    '''
+    def __init__(self, size, mtime, every):
+        self.size = size
+        self.mtime = mtime
+        self.every = every
+        self.nindivs = 0
+        self.pops = []
+        self.checkpoints = []
+
+    def is_current(self, fname):
+        '''Whether fname still has the indexed size and mtime.'''
+        stat = os.stat(fname)
+        return (self.size, self.mtime) == (stat.st_size, stat.st_mtime_ns)
+
+    def write(self, fname):
+        w = open(fname, 'w')
+        w.write('#gpindex\t%d\t%d\t%d\t%d\n' %
+                (self.size, self.mtime, self.every, self.nindivs))
+        for offset, first in self.pops:
+            w.write('P\t%d\t%d\n' % (offset, first))
+        for indiv, pop, offset in self.checkpoints:
+            w.write('I\t%d\t%d\t%d\n' % (indiv, pop, offset))
+        w.close()
+
+
+def build_index(fname, every=1000):
+    '''Indexes the byte offsets of populations and individuals.
+
+    :param fname: Genepop file
+    :param every: Every how many individuals an offset is kept
+
+    Returns a GenepopIndex.
+    '''
+    stat = os.stat(fname)
+    index = GenepopIndex(stat.st_size, stat.st_mtime_ns, every)
+    f = open(fname, 'rb')
+    offset = 0
+    pop = -1
+    for line in f:
+        stripped = line.strip()
+        if stripped.upper() == b'POP':
+            pop += 1
+            index.pops.append((offset, index.nindivs))
+        elif pop >= 0 and stripped != b'':
+            if index.nindivs % every == 0:
+                index.checkpoints.append((index.nindivs, pop, offset))
+            index.nindivs += 1
+        offset += len(line)
+    f.close()
+    return index
+
+
+def read_index(fname):
+    '''Reads an index written by GenepopIndex.write.'''
+    f = open(fname)
+    toks = f.readline().rstrip().split('\t')
+    if len(toks) != 5 or toks[0] != '#gpindex':
+        f.close()
+        raise GenomicsException('%s is not a Genepop index' % fname)
+    index = GenepopIndex(int(toks[1]), int(toks[2]), int(toks[3]))
+    index.nindivs = int(toks[4])
+    for line in f:
+        toks = line.rstrip().split('\t')
+        if toks[0] == 'P':
+            index.pops.append((int(toks[1]), int(toks[2])))
+        else:
+            index.checkpoints.append((int(toks[1]), int(toks[2]),
+                                      int(toks[3])))
+    f.close()
+    return index
+
+
+_gp_indexes = {}
+
+
+def get_index(fname, every=1000, index_fname=None):
+    '''Index of a Genepop file, kept in a sidecar file.
+
+    :param fname: Genepop file
+    :param every: Every how many individuals an offset is kept
+    :param index_fname: Sidecar file (default: fname.gpidx)
+
+    The index is (re)built if the sidecar is missing or if the size or
+    modification time of fname changed. If the sidecar cannot be
+    written (e.g. a read only directory) the index is only kept in
+    memory, pass a writable index_fname to persist it.
+    '''
+    if index_fname is None:
+        index_fname = fname + '.gpidx'
+    key = os.path.abspath(fname)
+    if key in _gp_indexes and _gp_indexes[key].is_current(fname):
+        return _gp_indexes[key]
+    if os.path.exists(index_fname):
+        try:
+            index = read_index(index_fname)
+            if index.is_current(fname):
+                _gp_indexes[key] = index
+                return index
+        except (GenomicsException, ValueError):
+            pass  # Rebuilt below
+    index = build_index(fname, every)
+    try:
+        index.write(index_fname)
+    except OSError:
+        pass  # Kept in memory only
+    _gp_indexes[key] = index
+    return index
+
+
+def _get_header(fname):
+    handle = open(fname)
+    record = read(handle)
+    handle.close()
+    return record.marker_len, len(record.loci_list)
+
+
+def _decode_or_empty(lines, marker_len, nloci):
+    if len(lines) == 0:
+        return [], numpy.zeros((0, nloci, 2), dtype=numpy.uint16)
+    return _decode_indivs(lines, marker_len, nloci)
+
+
+def read_population(fname, pop, index=None):
+    '''Reads a population of an indexed Genepop file.
+
+    :param fname: Genepop file
+    :param pop: Population index (from 0)
+    :param index: GenepopIndex (default: from get_index)
+
+    Seeks to the population, so each worker can read its own
+    populations with its own handle. Returns the names and an
+    (individuals x loci x ploidy) uint16 allele array.
+    '''
+    if index is None:
+        index = get_index(fname)
+    if pop < 0 or pop >= len(index.pops):
+        raise GenomicsException('There is no population %d' % pop)
+    marker_len, nloci = _get_header(fname)
+    f = open(fname, 'rb')
+    f.seek(index.pops[pop][0])
+    f.readline()  # POP
+    lines = []
+    for line in f:
+        line = line.decode().rstrip()
+        if line.upper() == 'POP':
+            break
+        if line != '':
+            lines.append(line)
+    f.close()
+    return _decode_or_empty(lines, marker_len, nloci)
+
+
+def read_individuals(fname, start, end, index=None):
+    '''Reads a range of individuals of an indexed Genepop file.
+
+    :param fname: Genepop file
+    :param start: First individual (from 0, across populations)
+    :param end: Last individual (exclusive)
+    :param index: GenepopIndex (default: from get_index)
+
+    Seeks to the closest indexed individual before start. Returns the
+    population index of each individual, the names and an
+    (individuals x loci x ploidy) uint16 allele array.
+    '''
+    if index is None:
+        index = get_index(fname)
+    end = min(end, index.nindivs)
+    marker_len, nloci = _get_header(fname)
+    if start >= end:
+        names, alleles = _decode_or_empty([], marker_len, nloci)
+        return numpy.zeros(0, dtype=numpy.int64), names, alleles
+    pos = bisect.bisect_right([cp[0] for cp in index.checkpoints], start)
+    indiv, pop, offset = index.checkpoints[max(pos - 1, 0)]
+    f = open(fname, 'rb')
+    f.seek(offset)
+    pops = []
+    lines = []
+    for line in f:
+        if indiv >= end:
+            break
+        line = line.decode().rstrip()
+        if line.upper() == 'POP':
+            pop += 1
+        elif line != '':
+            if indiv >= start:
+                pops.append(pop)
+                lines.append(line)
+            indiv += 1
+    f.close()
+    names, alleles = _decode_or_empty(lines, marker_len, nloci)
+    return numpy.array(pops, dtype=numpy.int64), names, alleles
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+'''
+.. module:: genomics.popgen.plink.bed
+   :synopsis: PLINK binary (bed/bim/fam) access
+   :noindex:
+   :copyright: Copyright 2014 by Tiago Antao
+   :license: GNU Affero, see LICENSE for details
+
+.. moduleauthor:: Tiago Antao <tra@popgen.net>
+
+'''
+import numpy
+
+from genomics import GenomicsException
+
+_MAGIC = [0x6c, 0x1b, 0x01]  # SNP-major mode
+
+# The four 2 bit genotypes of each byte, first sample on the low bits
+_UNPACK = numpy.array([[(byte >> (2 * i)) & 3 for i in range(4)]
+                       for byte in range(256)], dtype=numpy.uint8)
+
+# 00 homozygous A1, 01 missing, 10 heterozygous, 11 homozygous A2
+_A1_COUNTS = numpy.array([2, -1, 1, 0], dtype=numpy.int8)
+
+
+def _read_table(fname):
+    f = open(fname)
+    rows = [l.split() for l in f]
+    f.close()
+    return rows
+
+
+class BedReader(object):
+    '''Memory mapped reader of a PLINK binary fileset.
+
+    :param plink_pref: PLINK prefix (.bed, .bim and .fam)
+
+    bim and fam have the split lines of the .bim and .fam files.
+    Genotypes are only decoded when requested.
+    '''
+    def __init__(self, plink_pref):
+        self.bim = _read_table(plink_pref + '.bim')
+        self.fam = _read_table(plink_pref + '.fam')
+        self.nsnps = len(self.bim)
+        self.nsamples = len(self.fam)
+        bed = numpy.memmap(plink_pref + '.bed', dtype=numpy.uint8, mode='r')
+        if list(bed[:3]) != _MAGIC:
+            raise GenomicsException('%s.bed is not a SNP-major bed file' %
+                                    plink_pref)
+        self._bytes_per_snp = (self.nsamples + 3) // 4
+        self._bed = bed[3:3 + self.nsnps * self._bytes_per_snp].reshape(
+            self.nsnps, self._bytes_per_snp)
+
+    def get_genotypes(self, start=0, end=None, samples=None):
+        '''Number of A1 alleles per SNP and sample (-1 is missing).
+
+        :param start: First SNP
+        :param end: Last SNP (exclusive, default is all)
+        :param samples: Indexes of the samples (default is all)
+
+        Returns a (SNPs x samples) int8 array.
+        '''
+        packed = self._bed[start:end]
+        if samples is None:
+            codes = _UNPACK[packed].reshape(len(packed), -1)
+            codes = codes[:, :self.nsamples]
+        else:
+            samples = numpy.asarray(samples)
+            codes = (packed[:, samples // 4] >>
+                     (2 * (samples % 4)).astype(numpy.uint8)) & 3
+        return _A1_COUNTS[codes]
+
+    def get_alleles(self, start=0, end=None, samples=None, recode12=False):
+        '''Genotypes as PED allele characters.
+
+        :param start: First SNP
+        :param end: Last SNP (exclusive, default is all)
+        :param samples: Indexes of the samples (default is all)
+        :param recode12: Code A1 as 1 and A2 as 2 (as plink --recode12)
+
+        Returns a (samples x 2 * SNPs) uint8 array with the ASCII codes of
+        the alleles, laid out as the genotype columns of a PED file ('0'
+        is missing). Without recode12, alleles have to be single
+        characters.
+        '''
+        counts = self.get_genotypes(start, end, samples).T
+        snps = self.bim[start:end]
+        if recode12:
+            a1 = numpy.repeat(ord('1'), len(snps)).astype(numpy.uint8)
+            a2 = numpy.repeat(ord('2'), len(snps)).astype(numpy.uint8)
+        else:
+            if any(len(snp[4]) != 1 or len(snp[5]) != 1 for snp in snps):
+                raise GenomicsException(
+                    'Multi-character alleles (e.g. indels) are not supported'
+                    ', use recode12')
+            a1 = numpy.array([ord(snp[4]) for snp in snps], dtype=numpy.uint8)
+            a2 = numpy.array([ord(snp[5]) for snp in snps], dtype=numpy.uint8)
+        alleles = numpy.empty((len(counts), 2 * len(snps)),
+                              dtype=numpy.uint8)
+        alleles[:, 0::2] = numpy.where(counts >= 1, a1, a2)
+        alleles[:, 1::2] = numpy.where(counts == 2, a1, a2)
+        alleles[:, 0::2][counts < 0] = ord('0')
+        alleles[:, 1::2][counts < 0] = ord('0')
+        return alleles
@@ -10,179 +10,461 @@
 
 '''
 import os
+import tempfile
 
+import numpy
 
-def to_genepop(plink_pref, gp_pref, pop_dict, header="plink2gp"):
-    '''Converts a PED/MAP PLINK file to genepop.
+from genomics.popgen.plink.bed import BedReader
+from genomics.popgen.plink.ped import iter_ped_chunks, parse_ped_line, read_ped
 
-    :param plink_pref: PLINK prefix
-    :param gp_pref: Genepop prefix
-    :param pop_dict: Dictionary population -> [fam, ind]
-    :param header: Genepop header
+_ALLELES12 = numpy.array([ord('1'), ord('2')], dtype=numpy.uint8)
+_ALLELES12_MISSING = numpy.array([ord('0'), ord('1'), ord('2')],
+                                 dtype=numpy.uint8)
 
-    The Genepop file will be called gp_pref.gp.
+# Genepop 2 digit code of each PED allele (ASCII code), 00 is missing
+_GENEPOP_CODES = numpy.full((256, 2), ord('0'), dtype=numpy.uint8)
+for _i, _allele in enumerate('ACTG'):
+    _GENEPOP_CODES[ord(_allele), 1] = ord(str(_i + 1))
 
-    A gp_pref.pops file will report the order (sorted by name) of the
-        populations in the Genepop file.
+
+def _read_map(plink_pref):
+    '''Tokens of the .map file or, if there is none, the .bim file.
+
+    The first four columns of both are the same.
+    '''
+    if os.path.exists(plink_pref + '.map'):
+        f = open(plink_pref + '.map')
+    else:
+        f = open(plink_pref + '.bim')
+    snps = [l.split() for l in f]
+    f.close()
+    return snps
+
+
+def _count_ped(plink_pref):
+    f = open(plink_pref + '.ped', 'rb')
+    ninds = sum(1 for l in f if l.strip() != b'')
+    f.close()
+    return ninds
+
+
+def _encode_genepop(alleles):
+    '''Encodes PED alleles (uint8 ASCII codes) as Genepop genotypes.
+
+    Returns a string with a space before each (4 digit) genotype.
+    '''
+    codes = _GENEPOP_CODES[alleles].reshape(-1, 4)
+    genotypes = numpy.empty((len(codes), 5), dtype=numpy.uint8)
+    genotypes[:, 0] = ord(' ')
+    genotypes[:, 1:] = codes
+    return genotypes.tobytes().decode()
+
+
+def _index_ped(plink_pref, indiv_pops):
+    '''Byte offsets of the PED lines of each population (in file order).'''
+    offsets = {}
+    f = open(plink_pref + '.ped', 'rb')
+    offset = 0
+    for l in f:
+        toks = l.split(None, 2)
+        for pop in indiv_pops.get((toks[0].decode(), toks[1].decode()), []):
+            offsets.setdefault(pop, []).append(offset)
+        offset += len(l)
+    f.close()
+    return offsets
+
+
+def _iter_bed_individuals(reader, names, chunk_size=1024):
+    samples = [i for i, fam in enumerate(reader.fam)
+               if (fam[0], fam[1]) in names]
+    for start in range(0, len(samples), chunk_size):
+        chunk = samples[start:start + chunk_size]
+        for i, row in zip(chunk, reader.get_alleles(samples=chunk)):
+            yield (reader.fam[i][0], reader.fam[i][1]), row
+
+
+def _iter_ped_individuals(f, offsets):
+    for offset in offsets:
+        f.seek(offset)
+        fam, alleles = parse_ped_line(f.readline().decode())
+        yield (fam[0], fam[1]), alleles
+
+
+def _iter_pop_alleles(plink_pref, pop_names):
+    '''Iterates over the individuals of each population (sorted by name).
+
+    :param pop_names: Dictionary population -> set of (fam, ind)
+
+    Yields each population with an iterator over the (fam, ind) and
+    alleles of its individuals, in file order.
+    '''
+    pops = sorted(pop_names.keys())
+    if not os.path.exists(plink_pref + '.ped'):
+        reader = BedReader(plink_pref)
+        for pop in pops:
+            yield pop, _iter_bed_individuals(reader, pop_names[pop])
+        return
+    indiv_pops = {}
+    for pop in pops:
+        for name in pop_names[pop]:
+            indiv_pops.setdefault(name, []).append(pop)
+    offsets = _index_ped(plink_pref, indiv_pops)
+    f = open(plink_pref + '.ped', 'rb')
+    for pop in pops:
+        yield pop, _iter_ped_individuals(f, offsets.get(pop, []))
+    f.close()
+
+
+def _start_genepop(gp_pref, pop_dict, snps, header):
+    '''Writes the .pops file and the header and loci of the .gp file.
+
+    Returns the open .gp file and a dictionary population -> set of
+    (fam, ind).
     '''
-    ws = {}
     pops = list(pop_dict.keys())
     pops.sort()
     wGP = open(gp_pref + ".gp", "w")
     wGP.write(header + "\n")
-    indivPops = {}
 
     wPop = open(gp_pref + ".pops", "w")
     for pop in pops:
-        ws[pop] = open(str(os.getpid()) + "_" + pop, "w")
         wPop.write("%s\n" % pop)
-        for fam, ind in pop_dict[pop]:
-            indivPops.setdefault((fam, ind), []).append(pop)
     wPop.close()
 
-    f = open(plink_pref + ".map")
-    for l in f:
-        toks = l.rstrip().replace(" ", "\t").split("\t")
+    for toks in snps:
         chro = toks[0]
         rs = toks[1]
         pos = toks[3]
         wGP.write("%s/%s/%s\n" % (chro, rs, pos))
-    f.close()
 
-    f = open(plink_pref + ".ped")
-    for l in f:
-        toks = l.rstrip().replace(" ", "\t").split("\t")
-        fam = toks[0]
-        id = toks[1]
-        try:
-            my_pops = indivPops[(fam, id)]
-        except KeyError:
-            continue  # Not to be processed
-        for pop in my_pops:
-            ws[pop].write("%s/%s," % (fam, id))
-            alleles = toks[6:]
-            for i in range(len(alleles) // 2):
-                aStr = ""
-                for a in [alleles[2 * i], alleles[2 * i + 1]]:
-                    if a == "A":
-                        aStr += "01"
-                    elif a == "C":
-                        aStr += "02"
-                    elif a == "T":
-                        aStr += "03"
-                    elif a == "G":
-                        aStr += "04"
-                    else:
-                        aStr += "00"
-                ws[pop].write(" " + aStr)
-            ws[pop].write("\n")
+    pop_names = dict((pop, set((fam, ind) for fam, ind in pop_dict[pop]))
+                     for pop in pops)
+    return wGP, pop_names
 
-    for pop in pops:
-        ws[pop].close()
-        wGP.write("POP\n")
-        f = open(str(os.getpid()) + "_" + pop)
-        for l in f:
-            wGP.write(l)
-        f.close()
-        os.remove(str(os.getpid()) + "_" + pop)
-    wGP.close()
 
-
-def to_ldhat(plink_pref, ld_sites, ld_locs):
-    '''Converts a PED/MAP PLINK file to genepop.
+def to_genepop(plink_pref, gp_pref, pop_dict, header="plink2gp"):
+    '''Converts a PED/MAP (or BED/BIM/FAM) PLINK file to genepop.
 
     :param plink_pref: PLINK prefix
-    :param ld_sites: LD sites file
-    :param ld_sites: LD locs file
+    :param gp_pref: Genepop prefix
+    :param pop_dict: Dictionary population -> [fam, ind]
+    :param header: Genepop header
+
+    The Genepop file will be called gp_pref.gp.
+
+    A gp_pref.pops file will report the order (sorted by name) of the
+        populations in the Genepop file.
     '''
-    f = open(plink_pref + '.map')
+    wGP, pop_names = _start_genepop(gp_pref, pop_dict, _read_map(plink_pref),
+                                    header)
+    for pop, individuals in _iter_pop_alleles(plink_pref, pop_names):
+        wGP.write("POP\n")
+        for (fam, id), alleles in individuals:
+            wGP.write("%s/%s,%s\n" % (fam, id, _encode_genepop(alleles)))
+    wGP.close()
+
+
+def _write_ldhat_locs(ld_locs, snps):
     poses = []
     w = open(ld_locs, 'w')
-    for l in f:
-        toks = l.rstrip().replace(' ', '\t').split('\t')
+    for toks in snps:
         my_pos = int(toks[3])
         poses.append(my_pos / 1000)
-    f.close()
     w.write('%d %d L\n' % (len(poses), poses[-1] + 1))
     w.write('\n'.join([str(pos) for pos in poses]) + '\n')
     w.close()
 
-    f = open(plink_pref + '.ped')
-    ninds = 0
-    for l in f:
-        ninds += 1
-    f.close()
-    f = open(plink_pref + '.ped')
-    all_alleles = []
-    start = True
-    for l in f:
-        toks = l.rstrip().replace(" ", "\t").split("\t")
-        ind = toks[1]
-        alleles = toks[6:]
-        for i in range(len(alleles) // 2):
-            my_alleles = set([alleles[2 * i], alleles[2 * i + 1]])
-            if start:
-                all_alleles.append(my_alleles)
-            else:
-                all_alleles[i] |= my_alleles
-        start = False
-    f.close()
-    f = open(plink_pref + '.ped')
+
+def _write_ldhat_sites(ld_sites, nsnps, fams, alleles):
+    first = alleles[:, 0::2]
+    second = alleles[:, 1::2]
+    # The reference is the smallest allele of the locus, '0' included
+    ref = numpy.minimum(first.min(axis=0), second.min(axis=0))
     w = open(ld_sites, 'w')
-    w.write('%d %d 2\n' % (ninds, len(poses)))
-    for l in f:
-        toks = l.rstrip().replace(' ', '\t').split('\t')
-        ind = toks[1]
-        alleles = toks[6:]
-        w.write('>%s\n' % ind)
-        for i in range(len(alleles) // 2):
-            a1 = alleles[2 * i]
-            a2 = alleles[2 * i + 1]
-            if a1 != a2:
-                w.write('2')
-            else:
-                w.write('0' if a1 == min(all_alleles[i]) else '1')
-        w.write('\n')
+    w.write('%d %d 2\n' % (len(fams), nsnps))
+    for fam, a1, a2 in zip(fams, first, second):
+        sites = numpy.where(a1 != a2, ord('2'),
+                            numpy.where(a1 == ref, ord('0'), ord('1')))
+        sites = sites.astype(numpy.uint8).tobytes().decode()
+        w.write('>%s\n%s\n' % (fam[1], sites))
     w.close()
-    f.close()
 
 
-def to_eigen(plink_pref, eigen_pref):
-    '''Converts a PED/MAP 1/2 PLINK file to EIGENSOFT ind/snp/geno.
+def to_ldhat(plink_pref, ld_sites, ld_locs, processes=None):
+    '''Converts a PED/MAP (or BED/BIM/FAM) PLINK file to LDhat.
 
-    :param plink_pref: PLINK prefix (recode12)
-    :param eigen_pref: EIGENSOFT prefix
+    :param plink_pref: PLINK prefix
+    :param ld_sites: LD sites file
+    :param ld_sites: LD locs file
+    :param processes: PED parsing processes (see
+        :py:func:`genomics.popgen.plink.ped.iter_ped_chunks`)
     '''
-    f = open(plink_pref + '.ped')
-    iw = open(eigen_pref + '.ind', 'w')
-    snps = {}
-    for l in f:
-        toks = l.rstrip().replace(' ', '\t').split('\t')
-        # The above seems to change from plink 1 to 2
-        ind = toks[0] + '/' + toks[1]
-        iw.write(ind + '\tU\tControl\n')
-        for li in range(len(toks[6:]) // 2):
-            a1 = toks[2 * li + 6]
-            a2 = toks[2 * li + 6 + 1]
-            if a1 not in ['1', '2'] or a2 not in ['1', '2']:
-                snps[li] = snps.get(li, '') + '9'
-            else:
-                snps[li] = snps.get(li, '') + str(int(a1 == '1') + int(a2 == '1'))
-    iw.close()
+    snps = _read_map(plink_pref)
+    _write_ldhat_locs(ld_locs, snps)
+    fams, alleles = read_ped(plink_pref, processes=processes)
+    _write_ldhat_sites(ld_sites, len(snps), fams, alleles)
+
+
+def _hashit(name):
+    '''EIGENSOFT hash of a name (32 bit signed arithmetic).'''
+    value = 0
+    for c in name:
+        value = _to_int32(value * 23 + ord(c))
+    return value
+
+
+def _hasharr(names):
+    '''EIGENSOFT hash of a list of names.'''
+    value = 0
+    for name in names:
+        value = _to_int32(value * 17) ^ _hashit(name)
+    return value
+
+
+def _to_int32(value):
+    value &= 0xffffffff
+    return value - 0x100000000 if value & 0x80000000 else value
+
+
+def _new_geno_array(nrows, ncols, max_memory):
+    '''An uint8 rows x cols array, memory mapped if large.'''
+    if nrows * ncols <= max_memory:
+        return numpy.empty((nrows, ncols), dtype=numpy.uint8)
+    return numpy.memmap(tempfile.TemporaryFile(), dtype=numpy.uint8,
+                        mode='w+', shape=(nrows, ncols))
+
+
+def _count_alleles12(alleles):
+    '''Number of 1 alleles per individual and SNP (9 is missing).'''
+    known = numpy.isin(alleles, _ALLELES12)
+    known = known[:, 0::2] & known[:, 1::2]
+    counts = (alleles[:, 0::2] == ord('1')).astype(numpy.uint8) + \
+        (alleles[:, 1::2] == ord('1'))
+    return numpy.where(known, counts, 9).astype(numpy.uint8)
+
+
+def _get_minor_alleles(alleles, chunk_size=1024):
+    '''Minor allele (ASCII code) of each SNP of an allele matrix.
+
+    Only the smallest and largest allele of a SNP are considered, the
+    largest is the minor one on ties. Monomorphic SNPs get 0 (no
+    allele). The matrix is read chunk_size individuals at a time.
+    '''
+    nsnps = alleles.shape[1] // 2
+    lowest = numpy.full(nsnps, 255, dtype=numpy.uint8)
+    highest = numpy.zeros(nsnps, dtype=numpy.uint8)
+    for start in range(0, len(alleles), chunk_size):
+        block = alleles[start:start + chunk_size]
+        low = numpy.where(block == ord('0'), 255, block).min(axis=0)
+        high = block.max(axis=0)
+        lowest = numpy.minimum(lowest, numpy.minimum(low[0::2], low[1::2]))
+        highest = numpy.maximum(highest,
+                                numpy.maximum(high[0::2], high[1::2]))
+    nlowest = numpy.zeros(nsnps, dtype=numpy.int64)
+    nhighest = numpy.zeros(nsnps, dtype=numpy.int64)
+    for start in range(0, len(alleles), chunk_size):
+        block = alleles[start:start + chunk_size]
+        for genotypes in [block[:, 0::2], block[:, 1::2]]:
+            nlowest += (genotypes == lowest).sum(axis=0)
+            nhighest += (genotypes == highest).sum(axis=0)
+    minor = numpy.where(nlowest < nhighest, lowest, highest)
+    minor[lowest >= highest] = 0  # Monomorphic (or all missing)
+    return minor.astype(numpy.uint8)
+
+
+def _count_minor(alleles, minor):
+    '''Number of minor alleles per individual and SNP (9 is missing).'''
+    first = alleles[:, 0::2]
+    second = alleles[:, 1::2]
+    counts = (first == minor).astype(numpy.uint8) + (second == minor)
+    known = (first != ord('0')) & (second != ord('0'))
+    return numpy.where(known, counts, 9).astype(numpy.uint8)
+
+
+def _get_eigen_genotypes(plink_pref, nsnps, max_memory, processes=None,
+                         chunk_size=1024):
+    '''Reads the EIGENSOFT genotypes of a PLINK file.
+
+    Returns the individual names and a SNP x individual uint8 array
+    with the number of 1 alleles (9 is missing).
+    '''
+    if not os.path.exists(plink_pref + '.ped'):
+        reader = BedReader(plink_pref)
+        geno = _new_geno_array(nsnps, reader.nsamples, max_memory)
+        for start in range(0, nsnps, chunk_size):
+            counts = reader.get_genotypes(start, start + chunk_size)
+            geno[start:start + chunk_size] = numpy.where(counts < 0, 9,
+                                                         counts)
+        return [fam[0] + '/' + fam[1] for fam in reader.fam], geno
+    geno = _new_geno_array(nsnps, _count_ped(plink_pref), max_memory)
+    inds = []
+    for fams, alleles in iter_ped_chunks(plink_pref, processes):
+        if len(fams) == 0:
+            continue
+        geno[:, len(inds):len(inds) + len(fams)] = \
+            _count_alleles12(alleles).T
+        inds.extend(fam[0] + '/' + fam[1] for fam in fams)
+    return inds, geno
+
 
-    f = open(plink_pref + '.map')
+def _write_geno(geno, fname, chunk_size=1024):
+    '''Writes an EIGENSOFT text geno file.'''
+    w = open(fname, 'wb')
+    for start in range(0, len(geno), chunk_size):
+        block = geno[start:start + chunk_size]
+        rows = numpy.empty((len(block), block.shape[1] + 1),
+                           dtype=numpy.uint8)
+        rows[:, :-1] = block + ord('0')
+        rows[:, -1] = ord('\n')
+        w.write(rows.tobytes())
+    w.close()
+
+
+def _write_packed_geno(geno, fname, inds, snps, chunk_size=1024):
+    '''Writes an EIGENSTRAT packed geno file.
+
+    The header (GENO, number of individuals and SNPs and the hashes of
+    their names) and each SNP take a record of max(48, individuals / 4)
+    bytes. Each individual is coded by 2 bits (3 is missing), the first
+    individual on the high bits.
+    '''
+    ninds = geno.shape[1]
+    rlen = max(48, (ninds + 3) // 4)
+    header = ('GENO %7d %7d %x %x' % (
+        ninds, len(geno), _hasharr(inds) & 0xffffffff,
+        _hasharr(snps) & 0xffffffff)).encode()
+    w = open(fname, 'wb')
+    w.write(header + bytes(rlen - len(header)))
+    for start in range(0, len(geno), chunk_size):
+        block = geno[start:start + chunk_size]
+        codes = numpy.full((len(block), 4 * rlen), 3, dtype=numpy.uint8)
+        codes[:, :ninds] = numpy.where(block == 9, 3, block)
+        codes = codes.reshape(len(block), rlen, 4)
+        packed = ((codes[:, :, 0] << 6) | (codes[:, :, 1] << 4) |
+                  (codes[:, :, 2] << 2) | codes[:, :, 3])
+        w.write(packed.astype(numpy.uint8).tobytes())
+    w.close()
+
+
+def _write_eigen(eigen_pref, snps, inds, geno, packed):
     sw = open(eigen_pref + '.snp', 'w')
-    for l in f:
-        toks = l.rstrip().split('\t')
+    for toks in snps:
         chro = toks[0]
         sw.write('%s\t%s\t0.0\t%s\n' % (toks[1], chro, toks[3]))
     sw.close()
-    f.close()
 
-    gw = open(eigen_pref + '.geno', 'w')
-    poses = list(snps.keys())
-    poses.sort()
-    for pos in poses:
-        gw.write(snps[pos] + "\n")
-    gw.close()
-    f.close()
+    iw = open(eigen_pref + '.ind', 'w')
+    for ind in inds:
+        iw.write(ind + '\tU\tControl\n')
+    iw.close()
+
+    if packed:
+        _write_packed_geno(geno, eigen_pref + '.geno', inds,
+                           [toks[1] for toks in snps])
+    else:
+        _write_geno(geno, eigen_pref + '.geno')
+
+
+def to_eigen(plink_pref, eigen_pref, packed=False, max_memory=2 ** 30,
+             processes=None):
+    '''Converts a PED/MAP 1/2 PLINK file to EIGENSOFT ind/snp/geno.
+
+    :param plink_pref: PLINK prefix (recode12, or a BED/BIM/FAM fileset)
+    :param eigen_pref: EIGENSOFT prefix
+    :param packed: Write the geno file in EIGENSTRAT packed format
+    :param max_memory: Larger genotype matrices (in bytes) are kept in a
+        memory mapped temporary file
+    :param processes: PED parsing processes (see
+        :py:func:`genomics.popgen.plink.ped.iter_ped_chunks`)
+    '''
+    snps = _read_map(plink_pref)
+    inds, geno = _get_eigen_genotypes(plink_pref, len(snps), max_memory,
+                                      processes)
+    _write_eigen(eigen_pref, snps, inds, geno, packed)
+
+
+def _read_alleles(plink_pref, nsnps, max_memory, processes=None,
+                  chunk_size=1024):
+    '''Reads the genotypes of a PLINK file into a shared allele matrix.
+
+    As :py:func:`genomics.popgen.plink.ped.read_ped`, but the matrix
+    is memory mapped if larger than max_memory bytes.
+    '''
+    if not os.path.exists(plink_pref + '.ped'):
+        reader = BedReader(plink_pref)
+        alleles = _new_geno_array(reader.nsamples, 2 * nsnps, max_memory)
+        for start in range(0, reader.nsamples, chunk_size):
+            end = min(start + chunk_size, reader.nsamples)
+            alleles[start:end] = reader.get_alleles(
+                samples=range(start, end))
+        return [fam[:6] for fam in reader.fam], alleles
+    alleles = _new_geno_array(_count_ped(plink_pref), 2 * nsnps, max_memory)
+    fams = []
+    for chunk_fams, chunk in iter_ped_chunks(plink_pref, processes):
+        if len(chunk_fams) == 0:
+            continue
+        alleles[len(fams):len(fams) + len(chunk_fams)] = chunk
+        fams.extend(chunk_fams)
+    return fams, alleles
+
+
+def to_formats(plink_pref, gp_pref=None, pop_dict=None, ld_sites=None,
+               ld_locs=None, eigen_pref=None, header="plink2gp",
+               packed=False, recode12=None, max_memory=2 ** 30,
+               processes=None):
+    '''Converts a PLINK file to several formats reading it only once.
+
+    :param plink_pref: PLINK prefix (PED/MAP or BED/BIM/FAM)
+    :param gp_pref: Genepop prefix (with pop_dict and header, see
+        :py:func:`to_genepop`)
+    :param ld_sites: LDhat sites file (with ld_locs, see :py:func:`to_ldhat`)
+    :param eigen_pref: EIGENSOFT prefix (with packed, see
+        :py:func:`to_eigen`)
+    :param recode12: The PED is recode12 (default: all alleles are 0, 1
+        or 2). EIGENSOFT genotypes count allele 1 of recode12 data, A1 of
+        bed data (as :py:func:`to_eigen`) and the minor allele otherwise.
+    :param max_memory: Larger genotype matrices (in bytes) are kept in a
+        memory mapped temporary file
+    :param processes: PED parsing processes (see
+        :py:func:`genomics.popgen.plink.ped.iter_ped_chunks`)
+
+    Genotypes are parsed once into an allele matrix that all the
+    requested writers share.
+    '''
+    snps = _read_map(plink_pref)
+    fams, alleles = _read_alleles(plink_pref, len(snps), max_memory,
+                                  processes)
+
+    if gp_pref is not None:
+        wGP, pop_names = _start_genepop(gp_pref, pop_dict, snps, header)
+        for pop in sorted(pop_names.keys()):
+            wGP.write("POP\n")
+            for fam, row in zip(fams, alleles):
+                if (fam[0], fam[1]) in pop_names[pop]:
+                    wGP.write("%s/%s,%s\n" % (fam[0], fam[1],
+                                              _encode_genepop(row)))
+        wGP.close()
+
+    if ld_sites is not None:
+        _write_ldhat_locs(ld_locs, snps)
+        _write_ldhat_sites(ld_sites, len(snps), fams, alleles)
+
+    if eigen_pref is not None:
+        inds = [fam[0] + '/' + fam[1] for fam in fams]
+        if not os.path.exists(plink_pref + '.ped'):
+            # The bed is memory mapped, A1 counts are read directly
+            inds, geno = _get_eigen_genotypes(plink_pref, len(snps),
+                                              max_memory)
+        else:
+            if recode12 is None:
+                recode12 = numpy.isin(alleles, _ALLELES12_MISSING).all()
+            minor = None if recode12 else _get_minor_alleles(alleles)
+            geno = _new_geno_array(len(snps), len(fams), max_memory)
+            for start in range(0, len(fams), 1024):
+                block = alleles[start:start + 1024]
+                if recode12:
+                    counts = _count_alleles12(block)
+                else:
+                    counts = _count_minor(block, minor)
+                geno[:, start:start + 1024] = counts.T
+        _write_eigen(eigen_pref, snps, inds, geno, packed)
@@ -8,8 +8,13 @@
 
 .. moduleauthor:: Tiago Antao <tra@popgen.net>
 '''
+import itertools
 import os
 
+import numpy
+
+from genomics import GenomicsException
+
 
 def parse_sep_header(l, sep=' '):
     return [x for x in l.rstrip().split(sep) if x != '']
@@ -37,56 +42,231 @@ def parse_sep_body(l, sep=' ', field_ids=None, my_types=None):
         return toks
 
 
-def parse_sep(f, sep=' ', my_types=None):
+def _get_types(field_ids, my_types):
+    my_types = list(my_types or [])
+    return my_types + [str] * (len(field_ids) - len(my_types))
+
+
+def _get_index(field_ids, field):
+    try:
+        return field_ids.index(field)
+    except ValueError:
+        raise GenomicsException('Unknown field %s' % field)
+
+
+def _convert_value(toks, i, my_type):
+    if i >= len(toks):
+        return None
+    if my_type in [int, float] and toks[i] == 'NA':
+        return None
+    return my_type(toks[i])
+
+
+def parse_sep(f, sep=' ', my_types=None, fields=None, where=None):
+    '''Parses a file with a header, one dictionary per line.
+
+    :param fields: Fields to report (default is all)
+    :param where: Dictionary field -> predicate on its (converted) value
+
+    Lines are only reported if all predicates are true, a NA value
+    rejects the line. Predicates are evaluated before any other field
+    is converted.
+    '''
     field_ids = parse_sep_header(f.readline(), sep)
+    if fields is None and where is None:
+        for l in f:
+            yield parse_sep_body(l, sep, field_ids, my_types)
+        return
+    my_types = _get_types(field_ids, my_types)
+    fields = field_ids if fields is None else fields
+    selected = [(field, _get_index(field_ids, field)) for field in fields]
+    wheres = [(_get_index(field_ids, field), pred)
+              for field, pred in (where or {}).items()]
     for l in f:
-        yield parse_sep_body(l, sep, field_ids, my_types)
+        toks = parse_sep_header(l, sep)
+        accept = True
+        for i, pred in wheres:
+            value = _convert_value(toks, i, my_types[i])
+            if value is None or not pred(value):
+                accept = False
+                break
+        if accept:
+            yield dict((field, _convert_value(toks, i, my_types[i]))
+                       for field, i in selected)
 
 
-def parse_locus_miss(f):
-    '''Parse plink.lmiss file'''
-    for res in parse_sep(f, my_types=[int, str, int, int, float]):
-        yield res
+def _split_chunk(lines, sep, nfields):
+    '''Splits lines into a (lines x nfields) array of strings.
+
+    Missing trailing fields are NA.
+    '''
+    if sep == ' ':
+        toks = ''.join(lines).split()
+        if len(toks) == len(lines) * nfields:
+            return numpy.array(toks).reshape(len(lines), nfields)
+    rows = [(parse_sep_header(l, sep) + ['NA'] * nfields)[:nfields]
+            for l in lines]
+    return numpy.array(rows).reshape(len(lines), nfields)
+
+
+def _convert_column(values, my_type):
+    '''Converts an array of strings to my_type.
+
+    NA is nan, so int columns with NA are float.
+    '''
+    if my_type not in [int, float]:
+        return values
+    missing = values == 'NA'
+    if my_type is int and not missing.any():
+        return values.astype(numpy.int64)
+    return numpy.where(missing, 'nan', values).astype(numpy.float64)
+
+
+def parse_sep_columns(f, sep=' ', my_types=None, chunk_size=100000,
+                      fields=None, where=None):
+    '''Parses a file with a header into a dictionary of NumPy arrays.
+
+    The columnar counterpart of parse_sep: lines are split and
+    converted a chunk (of chunk_size lines) at a time.
+
+    where predicates get the converted column and return a boolean
+    array. Only the rows accepted by all of them are converted and
+    only for the requested fields.
+    '''
+    field_ids = parse_sep_header(f.readline(), sep)
+    my_types = _get_types(field_ids, my_types)
+    fields = field_ids if fields is None else fields
+    selected = [(field, _get_index(field_ids, field)) for field in fields]
+    wheres = [(_get_index(field_ids, field), pred)
+              for field, pred in (where or {}).items()]
+    columns = dict((field, []) for field in fields)
+    while True:
+        lines = [l for l in itertools.islice(f, chunk_size) if l.strip() != '']
+        if len(lines) == 0:
+            break
+        toks = _split_chunk(lines, sep, len(field_ids))
+        if len(wheres) > 0:
+            accept = numpy.ones(len(toks), dtype=bool)
+            for i, pred in wheres:
+                accept &= numpy.asarray(
+                    pred(_convert_column(toks[:, i], my_types[i])),
+                    dtype=bool)
+            toks = toks[accept]
+        for field, i in selected:
+            columns[field].append(_convert_column(toks[:, i], my_types[i]))
+    for field, i in selected:
+        if len(columns[field]) == 0:
+            columns[field] = _convert_column(numpy.array([], dtype=str),
+                                             my_types[i])
+        else:
+            columns[field] = numpy.concatenate(columns[field])
+    return columns
+
+
+def _filter_records(records, fields, where):
+    '''parse_sep fields and where on already converted records.'''
+    for rec in records:
+        if all(rec[field] is not None and pred(rec[field])
+               for field, pred in (where or {}).items()):
+            yield dict((field, rec[field])
+                       for field in (fields or rec.keys()))
+
+
+def _records_to_columns(records, field_ids):
+    columns = dict((field_id, []) for field_id in field_ids)
+    for rec in records:
+        for field_id in field_ids:
+            columns[field_id].append(rec[field_id])
+    return dict((field_id, numpy.array(values))
+                for field_id, values in columns.items())
+
+
+def _parse(f, my_types, columnar, chunk_size, fields, where):
+    if columnar:
+        return parse_sep_columns(f, my_types=my_types, chunk_size=chunk_size,
+                                 fields=fields, where=where)
+    return parse_sep(f, my_types=my_types, fields=fields, where=where)
+
 
+def parse_locus_miss(f, columnar=False, chunk_size=100000,
+                     fields=None, where=None):
+    '''Parse plink.lmiss file
 
-def parse_hwe(f):
-    '''Parse plink.hwe file'''
+    With columnar a dictionary of NumPy arrays is returned (see
+    parse_sep_columns), otherwise an iterator over one dictionary per
+    line. fields and where select columns and lines (see parse_sep),
+    e.g. where={'F_MISS': lambda x: x > 0.1} works in both modes.
+    The same applies to all parse_* functions.
+    '''
+    return _parse(f, [int, str, int, int, float], columnar, chunk_size,
+                  fields, where)
+
+
+def _iter_hwe(f, fields, where):
     for res in parse_sep(f, my_types=[int, str, str, str, str,
-                                      str, float, float, float]):
-        geno = res['GENO']
-        res['GENO'] = [int(x) for x in geno.split('/')]
+                                      str, float, float, float],
+                         fields=fields, where=where):
+        if 'GENO' in res:
+            geno = res['GENO']
+            res['GENO'] = [int(x) for x in geno.split('/')]
         yield res
 
 
-def parse_sex_check(f):
-    for res in parse_sep(f, my_types=[str, str, int, int, str, float]):
-        yield res
+def parse_hwe(f, columnar=False, chunk_size=100000,
+              fields=None, where=None):
+    '''Parse plink.hwe file
 
+    On columnar GENO is a (lines x 3) int array. where gets GENO as text.
+    '''
+    if not columnar:
+        return _iter_hwe(f, fields, where)
+    res = parse_sep_columns(f, my_types=[int, str, str, str, str,
+                                         str, float, float, float],
+                            chunk_size=chunk_size, fields=fields,
+                            where=where)
+    if 'GENO' not in res:
+        return res
+    res['GENO'] = numpy.array('/'.join(res['GENO']).split('/') if
+                              len(res['GENO']) > 0 else [],
+                              dtype=numpy.int64).reshape(-1, 3)
+    return res
 
-def parse_het(f):
-    for res in parse_sep(f, my_types=[str, str, int, float, int, float]):
-        yield res
 
+def parse_sex_check(f, columnar=False, chunk_size=100000,
+                    fields=None, where=None):
+    return _parse(f, [str, str, int, int, str, float], columnar, chunk_size,
+                  fields, where)
 
-def parse_genome(f):
-    for res in parse_sep(f, my_types=[str, str, str, str, str, str, float, float, float, float, int, float, float, float]):
-        yield res
 
+def parse_het(f, columnar=False, chunk_size=100000,
+              fields=None, where=None):
+    return _parse(f, [str, str, int, float, int, float], columnar,
+                  chunk_size, fields, where)
 
-def parse_freq(f):
-    for res in parse_sep(f, my_types=[int, str, str, str, float, int]):
-        yield res
 
+def parse_genome(f, columnar=False, chunk_size=100000,
+                 fields=None, where=None):
+    return _parse(f, [str, str, str, str, str, str, float, float, float,
+                      float, int, float, float, float], columnar, chunk_size,
+                  fields, where)
 
-def parse_r2(f):
-    for res in parse_sep(f, my_types=[int, int, str, int, int, str, float]):
-        yield res
 
+def parse_freq(f, columnar=False, chunk_size=100000,
+               fields=None, where=None):
+    return _parse(f, [int, str, str, str, float, int], columnar, chunk_size,
+                  fields, where)
 
-def parse_nearest(f):
+
+def parse_r2(f, columnar=False, chunk_size=100000,
+             fields=None, where=None):
+    return _parse(f, [int, int, str, int, int, str, float], columnar,
+                  chunk_size, fields, where)
+
+
+def _iter_nearest(f):
     f.readline()  # Header file
     for l in f:
-        toks = filter(lambda x: x != "", l.rstrip().split(" "))
+        toks = [x for x in l.rstrip().split(" ") if x != ""]
         t1 = max([12, len(toks[0]) + 1])
         t2 = max([13, len(toks[1]) + 1])
         t3 = max([13, len(toks[5]) + 1])
@@ -103,13 +283,121 @@ def parse_nearest(f):
                "z": z, "fid2": fid2, "iid2": iid2, "prop_diff": prop_diff}
 
 
+def parse_nearest(f, columnar=False, chunk_size=100000,
+                  fields=None, where=None):
+    '''Parse plink.nearest file (fixed width)'''
+    if not columnar:
+        return _filter_records(_iter_nearest(f), fields, where)
+    columns = _records_to_columns(_iter_nearest(f),
+                                  ["fid", "iid", "nn", "min_dst", "z",
+                                   "fid2", "iid2", "prop_diff"])
+    accept = numpy.ones(len(columns["fid"]), dtype=bool)
+    for field, pred in (where or {}).items():
+        accept &= numpy.asarray(pred(columns[field]), dtype=bool)
+    return dict((field, columns[field][accept])
+                for field in (fields or columns.keys()))
+
+
+def _get_chromosome(chro):
+    try:
+        return int(chro)
+    except ValueError:
+        return chro
+
+
 def get_snps(bim, accept_fun):
+    '''SNPs of a .bim file accepted by accept_fun(chro, pos).
+
+    chro is an int for numeric chromosomes and a string otherwise
+    (e.g. X or 2L).
+    '''
     f = open(bim)
     for l in f:
         toks = l.rstrip().replace(" ", "\t").split("\t")
-        chro = int(toks[0])
+        chro = _get_chromosome(toks[0])
         snp = toks[1]
         pos = int(toks[3])
         if accept_fun(chro, pos):
             yield snp
     f.close()
+
+
+class BimIndex(object):
+    '''Per chromosome sorted position index of a .bim (or .map) file.
+
+    Use get_bim_index to share indexes of the same file.
+    Chromosomes are referred by name, as in the file (e.g. 1 or '1').
+    '''
+    def __init__(self, bim):
+        chro_indexes = {}
+        snps = []
+        positions = []
+        f = open(bim)
+        for l in f:
+            toks = l.split(None, 4)
+            if len(toks) < 4:
+                continue
+            chro_indexes.setdefault(toks[0], []).append(len(snps))
+            snps.append(toks[1])
+            positions.append(int(toks[3]))
+        f.close()
+        # Only chromosome, SNP and position are kept (alleles can be long)
+        self.snps = numpy.empty(len(snps), dtype=object)
+        self.snps[:] = snps
+        positions = numpy.array(positions, dtype=numpy.int64)
+        self.chromosomes = {}
+        for chro, indexes in chro_indexes.items():
+            indexes = numpy.array(indexes, dtype=numpy.int64)
+            order = numpy.argsort(positions[indexes], kind='stable')
+            self.chromosomes[chro] = (positions[indexes][order],
+                                      indexes[order])
+
+    def _get_indexes(self, chro, start, end):
+        try:
+            positions, indexes = self.chromosomes[str(chro)]
+        except KeyError:
+            return numpy.empty(0, dtype=numpy.int64)
+        return indexes[numpy.searchsorted(positions, start, 'left'):
+                       numpy.searchsorted(positions, end, 'right')]
+
+    def query(self, regions):
+        '''SNPs in regions.
+
+        :param regions: List of (chromosome, start, end), 1 based and
+            inclusive as bim positions
+
+        Returns the SNP IDs and their indexes in the file, in file order.
+        '''
+        indexes = [self._get_indexes(chro, start, end)
+                   for chro, start, end in regions]
+        if len(indexes) == 0:
+            indexes = numpy.empty(0, dtype=numpy.int64)
+        else:
+            indexes = numpy.unique(numpy.concatenate(indexes))
+        return self.snps[indexes].tolist(), indexes
+
+    def query_bed(self, bed):
+        '''SNPs in the regions of a BED file (0 based, end exclusive).'''
+        regions = []
+        f = open(bed)
+        for l in f:
+            toks = l.split()
+            if len(toks) < 3 or toks[0] in ['track', 'browser'] or \
+                    toks[0].startswith('#'):
+                continue
+            regions.append((toks[0], int(toks[1]) + 1, int(toks[2])))
+        f.close()
+        return self.query(regions)
+
+
+_bim_indexes = {}
+
+
+def get_bim_index(bim):
+    '''BimIndex of a .bim file, cached while the file is unchanged.'''
+    stat = os.stat(bim)
+    key = os.path.abspath(bim)
+    version = stat.st_mtime, stat.st_size
+    if key not in _bim_indexes or _bim_indexes[key][0] != version:
+        _bim_indexes[key] = version, BimIndex(bim)
+    return _bim_indexes[key][1]
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+'''
+.. module:: genomics.popgen.plink.ped
+   :synopsis: PLINK PED genotypes as arrays
+   :noindex:
+   :copyright: Copyright 2014 by Tiago Antao
+   :license: GNU Affero, see LICENSE for details
+
+.. moduleauthor:: Tiago Antao <tra@popgen.net>
+
+'''
+import multiprocessing
+import os
+
+import numpy
+
+from genomics import GenomicsException
+from genomics.popgen.plink.bed import BedReader
+
+
+def parse_ped_line(l):
+    '''Parses a PED line into the 6 first tokens and the alleles.
+
+    The alleles are returned as an uint8 array with the ASCII code of
+    each allele. Only single character alleles are supported.
+    '''
+    toks = l.split()
+    alleles = ''.join(toks[6:]).encode()
+    if len(alleles) != len(toks) - 6:
+        raise GenomicsException(
+            'Individual %s has multi-character alleles (e.g. indels), '
+            'which are not supported' % toks[1])
+    return toks[:6], numpy.frombuffer(alleles, dtype=numpy.uint8)
+
+
+def get_chunks(fname, chunk_bytes):
+    '''Splits a file in (start, end) byte ranges on line boundaries.'''
+    size = os.path.getsize(fname)
+    chunks = []
+    f = open(fname, 'rb')
+    start = 0
+    while start < size:
+        if start + chunk_bytes >= size:
+            end = size
+        else:
+            f.seek(start + chunk_bytes - 1)
+            f.readline()
+            end = f.tell()
+        chunks.append((start, end))
+        start = end
+    f.close()
+    return chunks
+
+
+def parse_ped_chunk(fname, start, end):
+    '''Parses the PED lines between two byte offsets.
+
+    Returns the 6 first tokens of each individual and an
+    (individuals x 2 * SNPs) uint8 allele array.
+    '''
+    f = open(fname, 'rb')
+    f.seek(start)
+    lines = f.read(end - start).decode().splitlines()
+    f.close()
+    fams = []
+    rows = []
+    for l in lines:
+        if l.strip() == '':
+            continue
+        fam, alleles = parse_ped_line(l)
+        if len(rows) > 0 and len(alleles) != len(rows[0]):
+            raise GenomicsException(
+                'Individual %s has %d alleles, expected %d' %
+                (fam[1], len(alleles), len(rows[0])))
+        fams.append(fam)
+        rows.append(alleles)
+    if len(rows) == 0:
+        return fams, numpy.empty((0, 0), dtype=numpy.uint8)
+    return fams, numpy.array(rows)
+
+
+def iter_ped_chunks(plink_pref, processes=None, chunk_bytes=2 ** 26):
+    '''Parses a PED file in chunks, in parallel.
+
+    :param plink_pref: PLINK prefix
+    :param processes: Size of the process pool (default: all CPUs), 1
+        parses in this process. No pool is used for a single chunk.
+    :param chunk_bytes: Approximate size of each chunk
+
+    The file is split on line boundaries and the chunks are parsed
+    with :py:func:`parse_ped_chunk` by a process pool. Results are
+    yielded in file order.
+    '''
+    fname = plink_pref + '.ped'
+    tasks = [(fname, start, end)
+             for start, end in get_chunks(fname, chunk_bytes)]
+    if processes == 1 or len(tasks) < 2:
+        for task in tasks:
+            yield parse_ped_chunk(*task)
+        return
+    pool = multiprocessing.Pool(processes)
+    for fams, alleles in pool.imap(_parse_ped_task, tasks):
+        yield fams, alleles
+    pool.close()
+    pool.join()
+
+
+def _parse_ped_task(task):
+    return parse_ped_chunk(*task)
+
+
+def read_ped(plink_pref, recode12=False, processes=None,
+             chunk_bytes=2 ** 26):
+    '''Reads all the genotypes of a PLINK file.
+
+    :param plink_pref: PLINK prefix (.ped or, if there is none, .bed)
+    :param recode12: Code bed alleles as 1/2 (as plink --recode12)
+    :param processes: PED parsing processes (see :py:func:`iter_ped_chunks`)
+    :param chunk_bytes: Approximate size of each PED chunk
+
+    Returns the 6 first tokens of each individual and an
+    (individuals x 2 * SNPs) uint8 array with the ASCII code of the
+    alleles, as in the PED file ('0' is missing).
+    '''
+    if not os.path.exists(plink_pref + '.ped'):
+        reader = BedReader(plink_pref)
+        return ([fam[:6] for fam in reader.fam],
+                reader.get_alleles(recode12=recode12))
+    fams = []
+    blocks = []
+    for chunk_fams, alleles in iter_ped_chunks(plink_pref, processes,
+                                               chunk_bytes):
+        if len(chunk_fams) == 0:
+            continue
+        if len(blocks) > 0 and alleles.shape[1] != blocks[0].shape[1]:
+            raise GenomicsException(
+                'Individual %s has %d alleles, expected %d' %
+                (chunk_fams[0][1], alleles.shape[1], blocks[0].shape[1]))
+        fams.extend(chunk_fams)
+        blocks.append(alleles)
+    if len(blocks) == 0:
+        return fams, numpy.empty((0, 0), dtype=numpy.uint8)
+    return fams, numpy.concatenate(blocks)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+'''
+.. module:: genomics.popgen.plink.prune
+   :synopsis: LD based pruning of PLINK data
+   :noindex:
+   :copyright: Copyright 2014 by Tiago Antao
+   :license: GNU Affero, see LICENSE for details
+
+.. moduleauthor:: Tiago Antao <tra@popgen.net>
+
+'''
+from collections import deque
+
+import numpy
+
+from genomics import GenomicsException
+from genomics.popgen.stats import ld
+
+
+def _parse_tped_line(l):
+    '''Parses a TPED line into SNP information, dosage and observed mask.
+
+    The dosage counts the first allele seen on the line, '0' is missing.
+    '''
+    toks = l.split()
+    alleles = numpy.array(toks[4:]).reshape(-1, 2)
+    observed = (alleles != '0').all(axis=1)
+    seen = numpy.unique(alleles[observed])
+    if len(seen) > 2:
+        raise GenomicsException('SNP %s is not biallelic' % toks[1])
+    if len(seen) == 0:
+        dosage = numpy.zeros(len(alleles))
+    else:
+        ref = alleles[observed][0, 0]
+        dosage = (alleles == ref).sum(axis=1) * observed
+    return toks[0], toks[1], int(toks[3]), dosage, observed
+
+
+def ld_prune(plink_pref, prune_in, window_size=50, threshold=0.2,
+             window_bp=None):
+    '''Sliding window LD pruning of a transposed PLINK file.
+
+    :param plink_pref: PLINK prefix (a .tped as from plink --recode transpose)
+    :param prune_in: File where the names of the kept SNPs are written
+    :param window_size: Window size in number of SNPs
+    :param threshold: Maximum genotype r2 with a kept SNP
+    :param window_bp: Optional maximum window size in base pairs
+
+    SNPs are read one at a time. A SNP is kept if its genotype r2
+    (see :py:func:`genomics.popgen.stats.ld.calc_genotype_r2`) with
+    every kept SNP in the window is at most threshold. Missing genotypes
+    are ignored pair by pair. Only the window is held in memory.
+
+    Returns the number of kept SNPs.
+    '''
+    window = deque()
+    num_kept = 0
+    f = open(plink_pref + '.tped')
+    w = open(prune_in, 'w')
+    for index, l in enumerate(f):
+        chro, snp, pos, dosage, observed = _parse_tped_line(l)
+        while len(window) > 0 and (
+                window[0][1] != chro or
+                window[0][0] <= index - window_size or
+                (window_bp is not None and
+                 window[0][2] < pos - window_bp)):
+            window.popleft()
+        packed = ld._pack_dosages(dosage[:, None], observed[:, None])
+        if len(window) > 0:
+            kept = [entry[3] for entry in window]
+            win_packed = ([numpy.concatenate([x[0][i] for x in kept])
+                           for i in range(2)],
+                          numpy.concatenate([x[1] for x in kept]),
+                          numpy.concatenate([x[2] for x in kept]),
+                          numpy.concatenate([x[3] for x in kept]))
+            r2 = ld._genotype_r2_block(packed, win_packed, len(dosage))
+            if numpy.any(r2 > threshold):
+                continue
+        window.append((index, chro, pos, packed))
+        w.write('%s\n' % snp)
+        num_kept += 1
+    w.close()
+    f.close()
+    return num_kept
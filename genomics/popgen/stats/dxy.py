@@ -7,6 +7,15 @@
 '''
 from __future__ import division
 
+import itertools
+import multiprocessing
+
+import numpy
+
+from genomics import GenomicsException
+
+_N_CODES = numpy.frombuffer(b'nN', dtype=numpy.uint8)
+
 
 def calc_seq_freqs(seqs):
     """ Calculates the frequency of sequences.
@@ -53,41 +62,79 @@ def get_n_poses(seqs):
     return n_poses
 
 
+def encode_haplotypes(seqs):
+    """Encodes sequences of the same length as a uint8 matrix.
+
+    >>> encode_haplotypes(['AC', 'AN']).tolist()
+    [[65, 67], [65, 78]]
+    """
+    seqs = list(seqs)
+    return numpy.frombuffer(''.join(seqs).encode('ascii'),
+                            dtype=numpy.uint8).reshape(len(seqs), -1)
+
+
+def get_known_sites(*haps_list):
+    """Sites (columns) without n/N in any of the haplotype matrices."""
+    known = numpy.ones(haps_list[0].shape[1], dtype=bool)
+    for haps in haps_list:
+        known &= ~numpy.isin(haps, _N_CODES).any(axis=0)
+    return known
+
+
+def calc_num_diffs_matrix(haps1, haps2, block_size=4096):
+    """Number of differences between every pair of rows of two matrices.
+
+    Equal sites are counted with one matrix product per nucleotide over
+    blocks of sites (float32 products are exact within a block).
+
+    >>> calc_num_diffs_matrix(encode_haplotypes(['AC', 'CC']),
+    ...                       encode_haplotypes(['AA', 'AC', 'TT']))
+    array([[1, 0, 2],
+           [2, 1, 2]])
+    """
+    nsites = haps1.shape[1]
+    same = numpy.zeros((len(haps1), len(haps2)), dtype=numpy.int64)
+    for start in range(0, nsites, block_size):
+        block1 = haps1[:, start:start + block_size]
+        block2 = haps2[:, start:start + block_size]
+        for code in numpy.intersect1d(block1, block2):
+            same += numpy.dot(
+                (block1 == code).astype(numpy.float32),
+                (block2 == code).T.astype(numpy.float32)).astype(
+                    numpy.int64)
+    return nsites - same
+
+
+def calc_pi_XY_haps(haps1, freqs1, haps2, freqs2):
+    """pi_XY from haplotype matrices and their frequencies.
+
+    Sites with n/N in any haplotype are ignored.
+
+    Returns:
+        pi_XY and the number of sites used
+    """
+    known = get_known_sites(haps1, haps2)
+    nsites = int(known.sum())
+    diffs = calc_num_diffs_matrix(haps1[:, known], haps2[:, known])
+    pi_XY = numpy.dot(numpy.dot(freqs1, diffs), freqs2) / nsites
+    return float(pi_XY), nsites
+
+
+def _get_haps_freqs(seq_freq):
+    seqs = list(seq_freq.keys())
+    return (encode_haplotypes(seqs),
+            numpy.array([seq_freq[seq] for seq in seqs]))
+
+
 def calc_pi_XY(seq_freq1, seq_freq2):
-    pi_XY = 0.0
-    seqs1 = list(seq_freq1.keys())
-    seqs2 = list(seq_freq2.keys())
-    nposes = get_n_poses(seqs1 + seqs2)
-
-    def convert_seq_freq(nposes, old_sfreq):
-        new_seqs = set()
-        sfreq = {}
-        for old_seq, freq in old_sfreq.items():
-            new_seq = "".join([old_seq[i]
-                               for i in range(len(old_seq))
-                               if i not in nposes])
-            if new_seq in new_seqs:
-                sfreq[new_seq] += freq
-            else:
-                new_seqs.add(new_seq)
-                sfreq[new_seq] = freq
-        return sfreq
-    seq_freq1 = convert_seq_freq(nposes, seq_freq1)
-    seq_freq2 = convert_seq_freq(nposes, seq_freq2)
-    seqs1 = list(seq_freq1.keys())
-    seqs2 = list(seq_freq2.keys())
-    for i in range(len(seqs1)):
-        seq1 = seqs1[i]
-        len_seq = len(seq1)
-        fi = seq_freq1[seq1]
-        for j in range(len(seqs2)):
-            seq2 = seqs2[j]
-            if seq1 == seq2:
-                continue
-            fj = seq_freq2[seq2]
-            num_diffs = calc_num_diffs(seq1, seq2)
-            pi_XY += fi * fj * (num_diffs / len_seq)
-    return pi_XY, len(seq1)
+    """pi_XY between two dicts of sequence -> frequency.
+
+    >>> calc_pi_XY({'AAAA': 0.5, 'ACAN': 0.5}, {'TAAA': 1.0})
+    (0.5, 3)
+    """
+    haps1, freqs1 = _get_haps_freqs(seq_freq1)
+    haps2, freqs2 = _get_haps_freqs(seq_freq2)
+    return calc_pi_XY_haps(haps1, freqs1, haps2, freqs2)
 
 
 def calc_nuc_div(seq_freq):
@@ -103,6 +150,444 @@ def calc_d_XY(seq_freq1, seq_freq2, num_freqs1, num_freqs2):
     d_XY = pi_XY - (pi1 + pi2) / 2
     return d_XY, (pi_XY, pi1, pi2, lseq)
 
+
+class HaplotypeDistanceCache(object):
+    """Caches pairwise difference matrices between sets of haplotypes.
+
+    A set of haplotypes is identified by its distinct sequences, so the
+    within population differences of a population are computed once
+    however many populations it is compared with.
+
+    >>> cache = HaplotypeDistanceCache()
+    >>> cache.calc_pi_XY({'AA': 0.5, 'AC': 0.5}, {'AA': 0.5, 'AC': 0.5})
+    (0.25, 2)
+    >>> cache.calc_pi_XY({'AC': 0.5, 'AA': 0.5}, {'AA': 0.5, 'AC': 0.5})
+    (0.25, 2)
+    >>> len(cache)
+    1
+    """
+    def __init__(self):
+        self._haps = {}
+        self._diffs = {}
+
+    def __len__(self):
+        return len(self._diffs)
+
+    def _get_haps(self, seq_freq):
+        key = tuple(sorted(seq_freq.keys()))
+        if key not in self._haps:
+            self._haps[key] = encode_haplotypes(key)
+        return key, self._haps[key], numpy.array([seq_freq[seq]
+                                                  for seq in key])
+
+    def calc_pi_XY(self, seq_freq1, seq_freq2):
+        """As calc_pi_XY, reusing previously computed differences."""
+        key1, haps1, freqs1 = self._get_haps(seq_freq1)
+        key2, haps2, freqs2 = self._get_haps(seq_freq2)
+        known = get_known_sites(haps1, haps2)
+        nsites = int(known.sum())
+        swap = key2 < key1
+        diff_key = (key2, key1) if swap else (key1, key2)
+        diff_key += (known.tobytes(),)
+        if diff_key not in self._diffs:
+            if swap:
+                diffs = calc_num_diffs_matrix(haps2[:, known],
+                                              haps1[:, known])
+            else:
+                diffs = calc_num_diffs_matrix(haps1[:, known],
+                                              haps2[:, known])
+            self._diffs[diff_key] = diffs
+        diffs = self._diffs[diff_key]
+        if swap:
+            diffs = diffs.T
+        pi_XY = numpy.dot(numpy.dot(freqs1, diffs), freqs2) / nsites
+        return float(pi_XY), nsites
+
+
+def calc_d_XY_matrix(populations, cache=None):
+    """d_XY between all pairs of populations.
+
+    :param populations: List of populations, each a list of sequences
+    :param cache: A HaplotypeDistanceCache (to share between calls)
+
+    Each within and between population difference matrix is computed
+    once.
+
+    Returns:
+        d_XY matrix, pi_XY matrix and the list of pi of each population
+        (all as in calc_d_XY)
+
+    >>> d_XY, pi_XY, pis = calc_d_XY_matrix([['AA', 'AC'], ['CC', 'CC'],
+    ...                                      ['AC', 'AC']])
+    >>> d_XY.tolist()
+    [[0.0, 0.5, 0.0], [0.5, 0.0, 0.5], [0.0, 0.5, 0.0]]
+    """
+    if cache is None:
+        cache = HaplotypeDistanceCache()
+    seq_freqs = [calc_seq_freqs(seqs) for seqs in populations]
+    pis = [len(seqs) / (len(seqs) - 1) *
+           cache.calc_pi_XY(seq_freq, seq_freq)[0]
+           for seqs, seq_freq in zip(populations, seq_freqs)]
+    npops = len(populations)
+    d_XY = numpy.zeros((npops, npops))
+    pi_XY = numpy.zeros((npops, npops))
+    for i in range(npops):
+        pi_XY[i, i] = pis[i] * (len(populations[i]) - 1) / \
+            len(populations[i])
+        for j in range(i + 1, npops):
+            pi_XY[i, j] = pi_XY[j, i] = cache.calc_pi_XY(seq_freqs[i],
+                                                         seq_freqs[j])[0]
+            d_XY[i, j] = d_XY[j, i] = pi_XY[i, j] - (pis[i] + pis[j]) / 2
+    return d_XY, pi_XY, pis
+
+
+def _calc_site_stats(haps1, haps2):
+    """Per site pi_XY and within population diversities.
+
+    Site values come from nucleotide frequencies: pi_XY is
+    1 - sum(p1 * p2) and the diversity of a population 1 - sum(p ** 2).
+    As in calc_d_XY, pi_XY ignores sites with n/N in any sequence and each
+    diversity sites with n/N in its own population.
+
+    Returns:
+        pi_XY, diversity 1, diversity 2 (0 at ignored sites) and the
+        corresponding masks of used sites
+    """
+    known1 = get_known_sites(haps1)
+    known2 = get_known_sites(haps2)
+    pi_XY = numpy.ones(haps1.shape[1])
+    div1 = numpy.ones(haps1.shape[1])
+    div2 = numpy.ones(haps1.shape[1])
+    for code in numpy.union1d(numpy.unique(haps1), numpy.unique(haps2)):
+        p1 = (haps1 == code).mean(axis=0)
+        p2 = (haps2 == code).mean(axis=0)
+        pi_XY -= p1 * p2
+        div1 -= p1 ** 2
+        div2 -= p2 ** 2
+    known = known1 & known2
+    return (pi_XY * known, div1 * known1, div2 * known2,
+            known, known1, known2)
+
+
+def scan_windows(haps1, haps2, positions, wsize, wstep, start=1, end=None):
+    """Sliding window pi and d_XY along a chromosome.
+
+    :param haps1: Haplotype matrix (one row per sequence) of population 1
+    :param haps2: Haplotype matrix of population 2
+    :param positions: Sorted position of each site (column)
+    :param wsize: Window size
+    :param wstep: Window step
+    :param start: Start of the first window
+    :param end: Last position to scan (default: last site)
+
+    Values are as in calc_d_XY for the sites of each window, using the
+    number of rows as sample size. Site values are computed once and
+    each window is a difference of cumulative sums.
+
+    Returns:
+        dict of arrays: start, nsites, pi1, pi2, pi_XY and d_XY (nan for
+        windows without sites)
+
+    >>> wins = scan_windows(encode_haplotypes(['AAT', 'AAA']),
+    ...                     encode_haplotypes(['CAA', 'CAA']),
+    ...                     [1, 5, 12], 10, 10)
+    >>> wins['nsites'].tolist(), wins['pi_XY'].tolist()
+    ([2, 1], [0.5, 0.5])
+    """
+    positions = numpy.asarray(positions)
+    end = positions[-1] if end is None else end
+    cumulative = [numpy.concatenate([[0], numpy.cumsum(x)])
+                  for x in _calc_site_stats(haps1, haps2)]
+    starts = numpy.arange(start, end + 1, wstep)
+    first = numpy.searchsorted(positions, starts)
+    last = numpy.searchsorted(positions, starts + wsize)
+    pi_XY, div1, div2, nsites, nsites1, nsites2 = [
+        x[last] - x[first] for x in cumulative]
+    n1, n2 = len(haps1), len(haps2)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        pi_XY = pi_XY / nsites
+        pi1 = n1 / (n1 - 1) * div1 / nsites1
+        pi2 = n2 / (n2 - 1) * div2 / nsites2
+    return {'start': starts, 'nsites': nsites.astype(numpy.int64),
+            'pi1': pi1, 'pi2': pi2, 'pi_XY': pi_XY,
+            'd_XY': pi_XY - (pi1 + pi2) / 2}
+
+
+def write_windows(db, chromosome, windows, stat='d_XY'):
+    """Writes a statistic of scan_windows to a genomics.db.DB.
+
+    :param db: Database (with a GenomeSchema)
+    :param chromosome: Chromosome of the windows
+    :param windows: The output of scan_windows
+    :param stat: Statistic to write, the key is the window start
+    """
+    from genomics.db import Key
+    granularity = db.schema.granularity
+    node = None
+    for pos, value in zip(windows['start'], windows[stat]):
+        node_pos = 1 + (pos - 1) // granularity * granularity
+        if node is None or node.key.position != node_pos:
+            if node is not None:
+                node.commit()
+            node = db.get_write_node(Key(['chromosome', 'position'],
+                                         chromosome, int(node_pos)))
+        node.assign(int(pos), float(value))
+    if node is not None:
+        node.commit()
+
+
+class FastaColumnReader(object):
+    """Reads column blocks of an aligned multi-sample FASTA file.
+
+    :param fname: FASTA file name
+
+    The file is indexed on creation (as samtools faidx does: sequence
+    offset and line width of each record), after that a block of columns
+    is read by seeking into each record. All sequences have to be of the
+    same length and, within a record, all lines but the last of the
+    same width.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.names = []
+        self._index = []
+        self._index_file()
+        lengths = set([entry[1] for entry in self._index])
+        if len(lengths) > 1:
+            raise GenomicsException('Sequences have different lengths')
+        self.length = lengths.pop() if len(lengths) > 0 else 0
+
+    def _index_file(self):
+        f = open(self.fname, 'rb')
+        offset = 0
+        record = None
+        for l in f:
+            if l.startswith(b'>'):
+                if record is not None:
+                    self._index.append(tuple(record))
+                self.names.append(l[1:].decode().split()[0])
+                # offset, length, line bases, line bytes, last line seen
+                record = [offset + len(l), 0, None, None, False]
+            elif record is not None:
+                bases = len(l.rstrip(b'\r\n'))
+                if record[4] and bases > 0:
+                    raise GenomicsException(
+                        'Lines of %s have different widths' %
+                        self.names[-1])
+                if record[2] is None:
+                    record[2], record[3] = bases, len(l)
+                elif bases != record[2] or len(l) != record[3]:
+                    record[4] = True
+                record[1] += bases
+            offset += len(l)
+        if record is not None:
+            self._index.append(tuple(record))
+        f.close()
+        self._index = [entry[:4] for entry in self._index]
+
+    def get_block(self, start, end, names=None):
+        """Haplotype matrix (see encode_haplotypes) of columns start to end.
+
+        :param names: Samples to read (default all, in file order)
+        """
+        names = self.names if names is None else names
+        end = min(end, self.length)
+        block = numpy.empty((len(names), end - start), dtype=numpy.uint8)
+        f = open(self.fname, 'rb')
+        for row, name in enumerate(names):
+            offset, length, line_bases, line_bytes = \
+                self._index[self.names.index(name)]
+            first = offset + start // line_bases * line_bytes + \
+                start % line_bases
+            last = offset + end // line_bases * line_bytes + \
+                end % line_bases
+            f.seek(first)
+            seq = f.read(last - first).replace(b'\n', b'').replace(b'\r',
+                                                                   b'')
+            block[row] = numpy.frombuffer(seq[:end - start],
+                                          dtype=numpy.uint8)
+        f.close()
+        return block
+
+    def iter_blocks(self, block_size, names=None):
+        """Generator of (start, haplotype matrix) column blocks."""
+        for start in range(0, self.length, block_size):
+            yield start, self.get_block(start, start + block_size, names)
+
+
+def _get_site_freqs(haps, codes):
+    """Frequency of each code (rows) at each site (columns)."""
+    return numpy.array([(haps == code).mean(axis=0) for code in codes])
+
+
+def calc_d_XY_stream(fname, sample_pop, block_size=100000):
+    """d_XY between all pairs of populations of an aligned FASTA file.
+
+    :param fname: FASTA file (see FastaColumnReader)
+    :param sample_pop: dict sample name -> population
+    :param block_size: Number of columns read at a time
+
+    The alignment is processed in column blocks, so memory depends on the
+    block size and not on the sequence length. Samples not in sample_pop
+    are ignored.
+
+    Returns:
+        dict (pop1, pop2) -> result of calc_d_XY for all pairs of sorted
+        populations, the number of samples being the sample size
+    """
+    reader = FastaColumnReader(fname)
+    pops = sorted(set(sample_pop.values()))
+    members = dict([(pop, [name for name in reader.names
+                           if sample_pop.get(name) == pop])
+                    for pop in pops])
+    pairs = list(itertools.combinations(pops, 2))
+    div = dict([(pop, 0.0) for pop in pops])
+    div_sites = dict([(pop, 0) for pop in pops])
+    pi_XY = dict([(pair, 0.0) for pair in pairs])
+    pi_XY_sites = dict([(pair, 0) for pair in pairs])
+    for start, block in reader.iter_blocks(block_size):
+        rows = dict([(pop, block[[reader.names.index(name)
+                                  for name in members[pop]]])
+                     for pop in pops])
+        codes = numpy.unique(block)
+        freqs = dict([(pop, _get_site_freqs(rows[pop], codes))
+                      for pop in pops])
+        known = dict([(pop, get_known_sites(rows[pop])) for pop in pops])
+        for pop in pops:
+            div[pop] += ((1 - (freqs[pop] ** 2).sum(axis=0)) *
+                         known[pop]).sum()
+            div_sites[pop] += known[pop].sum()
+        for pop1, pop2 in pairs:
+            both = known[pop1] & known[pop2]
+            pi_XY[pop1, pop2] += ((1 - (freqs[pop1] *
+                                        freqs[pop2]).sum(axis=0)) *
+                                  both).sum()
+            pi_XY_sites[pop1, pop2] += both.sum()
+    pis = {}
+    for pop in pops:
+        n = len(members[pop])
+        pis[pop] = n / (n - 1) * div[pop] / div_sites[pop]
+    result = {}
+    for pop1, pop2 in pairs:
+        my_pi_XY = pi_XY[pop1, pop2] / pi_XY_sites[pop1, pop2]
+        result[pop1, pop2] = (my_pi_XY - (pis[pop1] + pis[pop2]) / 2,
+                              (my_pi_XY, pis[pop1], pis[pop2],
+                               int(pi_XY_sites[pop1, pop2])))
+    return result
+
+
+def calc_block_sums(haps1, haps2, block_size):
+    """Per block sums of site values for resampling.
+
+    :param haps1: Haplotype matrix (one row per sequence) of population 1
+    :param haps2: Haplotype matrix of population 2
+    :param block_size: Number of consecutive sites per block
+
+    Returns:
+        A (blocks x 6) array with the sums of pi_XY, diversity 1,
+        diversity 2 and the number of sites used for each of them
+    """
+    site_stats = numpy.array(_calc_site_stats(haps1, haps2),
+                             dtype=numpy.float64)
+    starts = numpy.arange(0, site_stats.shape[1], block_size)
+    return numpy.add.reduceat(site_stats, starts, axis=1).T
+
+
+def _d_XY_from_sums(sums, n1, n2):
+    """d_XY, pi_XY, pi1 and pi2 from (replicates x 6) sums."""
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        pi_XY = sums[:, 0] / sums[:, 3]
+        pi1 = n1 / (n1 - 1) * sums[:, 1] / sums[:, 4]
+        pi2 = n2 / (n2 - 1) * sums[:, 2] / sums[:, 5]
+    return pi_XY - (pi1 + pi2) / 2, pi_XY, pi1, pi2
+
+
+def _bootstrap_chunk(block_sums, n1, n2, replicates, seed):
+    rng = numpy.random.RandomState(seed)
+    nblocks = len(block_sums)
+    weights = rng.multinomial(nblocks, [1 / nblocks] * nblocks,
+                              size=replicates)
+    return numpy.array(_d_XY_from_sums(numpy.dot(weights, block_sums),
+                                       n1, n2))
+
+
+def bootstrap_d_XY(haps1, haps2, block_size, replicates=1000, alpha=0.05,
+                   seed=None, processes=1, chunk_size=100):
+    """Block bootstrap confidence intervals for d_XY and pi.
+
+    :param haps1: Haplotype matrix (one row per sequence) of population 1
+    :param haps2: Haplotype matrix of population 2
+    :param block_size: Number of consecutive sites per block
+    :param replicates: Number of bootstrap replicates
+    :param alpha: The intervals have 1 - alpha coverage
+    :param seed: Random seed
+    :param processes: Number of processes (None for all CPUs)
+    :param chunk_size: Replicates per task when using processes
+
+    Block differences are computed once, each replicate is a weighted sum
+    of the block sums (weights are the number of times a block is drawn).
+
+    Returns:
+        dict d_XY, pi_XY, pi1, pi2 -> (estimate, low, high) using
+        percentile intervals
+    """
+    block_sums = calc_block_sums(haps1, haps2, block_size)
+    n1, n2 = len(haps1), len(haps2)
+    seeds = numpy.random.RandomState(seed).randint(
+        0, 2 ** 31, size=(replicates + chunk_size - 1) // chunk_size)
+    tasks = [(block_sums, n1, n2,
+              min(chunk_size, replicates - i * chunk_size), chunk_seed)
+             for i, chunk_seed in enumerate(seeds)]
+    if processes == 1:
+        reps = [_bootstrap_chunk(*task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(processes)
+        reps = pool.starmap(_bootstrap_chunk, tasks)
+        pool.close()
+        pool.join()
+    reps = numpy.concatenate(reps, axis=1)
+    estimates = _d_XY_from_sums(block_sums.sum(axis=0)[None, :], n1, n2)
+    result = {}
+    for name, estimate, values in zip(['d_XY', 'pi_XY', 'pi1', 'pi2'],
+                                      estimates, reps):
+        low, high = numpy.nanpercentile(values, [100 * alpha / 2,
+                                                 100 * (1 - alpha / 2)])
+        result[name] = float(estimate[0]), float(low), float(high)
+    return result
+
+
+def jackknife_d_XY(haps1, haps2, block_size, alpha=0.05):
+    """Delete-one block jackknife confidence intervals for d_XY and pi.
+
+    :param haps1: Haplotype matrix (one row per sequence) of population 1
+    :param haps2: Haplotype matrix of population 2
+    :param block_size: Number of consecutive sites per block
+    :param alpha: The intervals have 1 - alpha coverage
+
+    All leave one out replicates come from the block sums at once.
+
+    Returns:
+        dict d_XY, pi_XY, pi1, pi2 -> (estimate, low, high) using the
+        jackknife standard error and a normal approximation
+    """
+    from scipy.stats import norm
+    block_sums = calc_block_sums(haps1, haps2, block_size)
+    n1, n2 = len(haps1), len(haps2)
+    nblocks = len(block_sums)
+    total = block_sums.sum(axis=0)
+    reps = _d_XY_from_sums(total[None, :] - block_sums, n1, n2)
+    estimates = _d_XY_from_sums(total[None, :], n1, n2)
+    z = norm.ppf(1 - alpha / 2)
+    result = {}
+    for name, estimate, values in zip(['d_XY', 'pi_XY', 'pi1', 'pi2'],
+                                      estimates, reps):
+        se = numpy.sqrt((nblocks - 1) / nblocks *
+                        ((values - values.mean()) ** 2).sum())
+        estimate = float(estimate[0])
+        result[name] = estimate, estimate - z * se, estimate + z * se
+    return result
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
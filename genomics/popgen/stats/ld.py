@@ -6,12 +6,28 @@
 .. moduleauthor:: Tiago Antao <tra@popgen.net>
 
 """
+import multiprocessing
+import os
+import shlex
+import shutil
+import sys
+import tempfile
 
+import numpy
 
-def _calc_burrows_pair(indp, indq):
+import genomics
+from genomics import GenomicsException
+
+
+def _calc_burrows_pair(indp, indq, ref_p=None, ref_q=None):
     """Calculate burrows between 2 loci
 
-    >> _calc_burrows_pair([(0, 1)], [(0, 1)])
+    The composite disequilibrium is reported for alleles ref_p and ref_q
+    (default: the smallest allele of each locus, Weir, 1979).
+
+    >>> round(_calc_burrows_pair([(0, 0), (0, 1), (1, 1)],
+    ...                          [(0, 0), (0, 1), (1, 1)]), 5)
+    0.33333
     """
     fp = {}
     fq = {}
@@ -51,18 +67,15 @@ def _calc_burrows_pair(indp, indq):
             PijIJ[p0, q1] = PijIJ.get((p0, q1), 0) + 1
             PijIJ[p1, q0] = PijIJ.get((p1, q0), 0) + 1
             PijIJ[p1, q1] = PijIJ.get((p1, q1), 0) + 1
-    Pijij = {k: 4 * v / len(indp) for k, v in Pijij.items()}
-    PijiJ = {k: 2 * v / len(indp) for k, v in PijiJ.items()}
-    PijIj = {k: 2 * v / len(indp) for k, v in PijIj.items()}
-    PijIJ = {k: v / len(indp) for k, v in PijIJ.items()}
-    p = list(fp.keys())[0]
-    q = list(fq.keys())[0]
-    rs = 0
-    for p in fp:
-        for q in fq:
-            rs += Pijij[p, q] + PijIj[p, q] + PijiJ[p, q] + PijIJ[p, q] -\
-                2 * fp[p] * fq[q]
-    return rs
+    Pijij = {k: 2 * v / len(indp) for k, v in Pijij.items()}
+    PijiJ = {k: v / len(indp) for k, v in PijiJ.items()}
+    PijIj = {k: v / len(indp) for k, v in PijIj.items()}
+    PijIJ = {k: v / (2 * len(indp)) for k, v in PijIJ.items()}
+    p = min(fp.keys()) if ref_p is None else ref_p
+    q = min(fq.keys()) if ref_q is None else ref_q
+    return Pijij.get((p, q), 0) + PijIj.get((p, q), 0) + \
+        PijiJ.get((p, q), 0) + PijIJ.get((p, q), 0) - \
+        2 * fp.get(p, 0) * fq.get(q, 0)
 
 
 def calc_burrows_delta(indlist):
@@ -74,22 +87,587 @@ def calc_burrows_delta(indlist):
             [('101', '000')] - One individual, 3 loci. First and last locus
             are Hz, middle is Ho(0)
 
+    Missing alleles are None. For each pair of loci only the individuals
+    known at both loci are used.
+
+    Delta is reported for the smallest allele (in sort order) of each
+    locus, over all individuals. So the reference allele does not depend
+    on the order of the individuals or on which of them are missing.
+
     Returns:
         List of burrows deltas. For the example above it would be composed
         of 3 values (between locus 1 and 2, 1 and 3, 2 and 3)
 
-    >> calc_burrows_delta([('3a', '3a'), ('3b', '3a')])[0]
-    0.59259
+    >>> [round(x, 5) for x in calc_burrows_delta([('00', '00'),
+    ...                                           ('01', '11')])]
+    [0.25]
+
+    """
+    return calc_burrows_delta_array(indlist).tolist()
+
+
+def encode_genotypes(indlist):
+    """Encodes a list of individuals as a matrix of allele indexes.
+
+    Parameters:
+        - indlist - List with a pair per individual (see calc_burrows_delta)
+
+    Alleles are numbered per locus in sort order, so allele 0, the
+    allele used to report Burrows delta, is the smallest allele of the
+    locus. Missing alleles (None) are coded as -1.
+
+    Returns:
+        An (individuals x loci x 2) int16 array and a list with the sorted
+        alleles of each locus
+
+    >>> geno, alleles = encode_genotypes([('ab', 'ba'), ('ba', 'ac')])
+    >>> geno[:, 1].tolist()
+    [[1, 0], [0, 2]]
+    >>> alleles
+    [['a', 'b'], ['a', 'b', 'c']]
+    >>> encode_genotypes([([None, 10], [2, 9])])[0].tolist()
+    [[[-1, 0], [1, 0]]]
+    """
+    raw = numpy.array([[list(ind[0]), list(ind[1])] for ind in indlist],
+                      dtype=object).transpose(0, 2, 1)
+    nind, nloci = raw.shape[:2]
+    known = ~numpy.equal(raw, None)
+    try:
+        uniq, code = numpy.unique(raw[known], return_inverse=True)
+    except TypeError:  # Alleles of different types, sorted as strings
+        uniq, code = numpy.unique(raw[known].astype(str),
+                                  return_inverse=True)
+    locus = numpy.broadcast_to(
+        numpy.arange(nloci, dtype=numpy.int64)[None, :, None], raw.shape)
+    # Keys sort by locus, then by allele
+    keys, inverse = numpy.unique(locus[known] * len(uniq) + code.ravel(),
+                                 return_inverse=True)
+    key_locus = keys // len(uniq)
+    starts = numpy.searchsorted(key_locus, numpy.arange(nloci))
+    allele_index = (numpy.arange(len(keys)) -
+                    starts[key_locus]).astype(numpy.int16)
+    geno = numpy.full((nind, nloci, 2), -1, dtype=numpy.int16)
+    geno[known] = allele_index[inverse.ravel()]
+    alleles = [[] for i in range(nloci)]
+    for key, key_loc in zip(keys, key_locus):
+        alleles[key_loc].append(uniq[key % len(uniq)])
+    return geno, alleles
+
+
+def _as_geno(data):
+    if isinstance(data, numpy.ndarray):
+        return data
+    return encode_genotypes(data)[0]
+
+
+def _get_observed(geno):
+    """Individuals with both alleles known per locus (None if all are)."""
+    observed = (geno >= 0).all(axis=2)
+    return None if observed.all() else observed
+
+
+def _get_dosages(geno):
+    """Number of copies of allele 0 per individual and locus.
+
+    Missing genotypes have a dosage of 0.
+    """
+    return ((geno == 0).sum(axis=2) *
+            (geno >= 0).all(axis=2)).astype(numpy.float64)
+
+
+def _condensed_offset(i, nloci):
+    """Position of pair (i, i + 1) in a condensed pair array."""
+    return i * nloci - i * (i + 1) // 2
+
+
+def _joint_sums(x, y, observed, weights, rows, cols):
+    """Sums over the individuals observed at both loci of each pair.
+
+    Returns the (weighted) number of individuals and the sums of x * y,
+    x and y, all as (rows x cols) arrays.
+    """
+    if observed is None:
+        mx = numpy.ones((x.shape[0], 1))
+        my = mx
+    else:
+        mx = observed[:, rows].astype(numpy.float64)
+        my = observed[:, cols].astype(numpy.float64)
+    if weights is not None:
+        x = x * weights[:, None]
+        mx = mx * weights[:, None]
+    n = numpy.dot(mx.T, my)
+    if observed is None:
+        return n, numpy.dot(x.T, y), x.sum(axis=0)[:, None], \
+            numpy.dot(mx.T, y)
+    return n, numpy.dot(x.T, y), numpy.dot(x.T, my), numpy.dot(mx.T, y)
+
+
+def _burrows_block(dosage, rows, cols, observed=None, weights=None):
+    """Burrows delta between two blocks of loci (slices of dosage).
+
+    Delta is half the covariance of the allele dosages, so all pairs of
+    the blocks come from matrix products.
+    """
+    x = dosage[:, rows]
+    y = dosage[:, cols]
+    n, sxy, sx, sy = _joint_sums(x, y, observed, weights, rows, cols)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return sxy / (2 * n) - sx * sy / (2 * n ** 2)
+
+
+def _burrows_r2_block(dosage, rows, cols, observed=None, weights=None):
+    """Burrows r2 and number of individuals between two blocks of loci.
+
+    r is delta over the square root of the product of
+    p(1 - p) + (h - p ** 2) at both loci, h being the homozygote
+    frequency (Weir, 1979).
+    """
+    x = dosage[:, rows]
+    y = dosage[:, cols]
+    n, sxy, sx, sy = _joint_sums(x, y, observed, weights, rows, cols)
+    hx = _joint_sums((x == 2) * 1.0, (y == 2) * 1.0, observed, weights,
+                     rows, cols)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        delta = sxy / (2 * n) - sx * sy / (2 * n ** 2)
+        px, py = sx / (2 * n), sy / (2 * n)
+        vx = px * (1 - px) + hx[2] / n - px ** 2
+        vy = py * (1 - py) + hx[3] / n - py ** 2
+        r2 = delta ** 2 / (vx * vy)
+    if observed is None:
+        count = numpy.full(delta.shape, dosage.shape[0], dtype=numpy.int64)
+    else:
+        count = numpy.dot(observed[:, rows].T.astype(numpy.int64),
+                          observed[:, cols])
+    return r2, count
+
+
+def _get_burrows_inputs(indlist, weights):
+    geno = _as_geno(indlist)
+    if weights is not None:
+        weights = numpy.asarray(weights, dtype=numpy.float64)
+    return _get_dosages(geno), _get_observed(geno), weights
+
+
+def calc_burrows_delta_array(indlist, batch_size=256, weights=None):
+    """Calculates Burrows delta for all pairs of loci with matrix products.
+
+    Parameters:
+        - indlist - List with a pair per individual (see calc_burrows_delta)
+          or the genotype matrix returned by encode_genotypes
+        - batch_size - Number of loci compared against all others at once
+        - weights - Optional weight of each individual
+
+    Missing genotypes are masked once and each pair uses the individuals
+    observed at both loci.
+
+    Returns:
+        A condensed array with the same values and order as
+        calc_burrows_delta (1-2, 1-3, ..., 2-3, ...)
+
+    >>> calc_burrows_delta_array([('00', '00'), ('01', '11')])
+    array([0.25])
+    """
+    dosage, observed, weights = _get_burrows_inputs(indlist, weights)
+    return _calc_condensed(
+        lambda rows, cols: (_burrows_block(dosage, rows, cols,
+                                           observed, weights),),
+        dosage.shape[1], batch_size)[0]
+
+
+def calc_burrows_r2(indlist, batch_size=256, weights=None):
+    """Calculates Burrows r2 for all pairs of loci.
+
+    Parameters are as in calc_burrows_delta_array.
+
+    r2 is the squared Burrows correlation (Weir, 1979) as used by
+    NeEstimator, see correct_r2_bias.
+
+    Returns:
+        Condensed arrays of r2 and of the number of individuals observed
+        at both loci, in the same order as calc_burrows_delta
+
+    >>> r2, n = calc_burrows_r2([('00', '00'), ('01', '11'),
+    ...                          ('11', (None, '1'))])
+    >>> r2, n
+    (array([1.]), array([2]))
+    """
+    dosage, observed, weights = _get_burrows_inputs(indlist, weights)
+    return tuple(_calc_condensed(
+        lambda rows, cols: _burrows_r2_block(dosage, rows, cols,
+                                             observed, weights),
+        dosage.shape[1], batch_size))
+
+
+def correct_r2_bias(r2, n):
+    """Removes the expected sampling r2 from r2 (Waples, 2006).
+
+    Parameters:
+        - r2 - r2 values (e.g. from calc_burrows_r2)
+        - n - Number of individuals used for each r2
+
+    The expectation is 1/S + 3.19/S^2 for S >= 30 and
+    0.0018 + 0.907/S + 4.44/S^2 below, S being the sample size.
+
+    >>> correct_r2_bias(numpy.array([0.1, 0.1]), numpy.array([100, 20]))
+    array([0.089681, 0.04175 ])
+    """
+    n = numpy.asarray(n, dtype=numpy.float64)
+    expected = numpy.where(n >= 30, 1 / n + 3.19 / n ** 2,
+                           0.0018 + 0.907 / n + 4.44 / n ** 2)
+    return r2 - expected
+
+
+def _calc_condensed(block_fun, nloci, batch_size):
+    """Fills condensed pair arrays from blocks of a pairwise statistic.
+
+    block_fun(rows, cols) returns a tuple of (rows x cols) arrays.
+    """
+    outputs = None
+    for start in range(0, nloci - 1, batch_size):
+        end = min(start + batch_size, nloci - 1)
+        blocks = block_fun(slice(start, end), slice(start, nloci))
+        if outputs is None:
+            outputs = [numpy.empty(nloci * (nloci - 1) // 2,
+                                   dtype=block.dtype)
+                       for block in blocks]
+        for output, block in zip(outputs, blocks):
+            for i in range(start, end):
+                offset = _condensed_offset(i, nloci)
+                output[offset:offset + nloci - i - 1] = \
+                    block[i - start, i - start + 1:]
+    if outputs is None:
+        return [numpy.empty(0)] * 2
+    return outputs
+
+
+def _get_band_ends(nloci, max_loci=None, max_bp=None, positions=None):
+    """Exclusive end of the band of loci starting at each locus."""
+    if max_loci is None and max_bp is None:
+        raise GenomicsException('Either max_loci or max_bp is needed')
+    ends = numpy.repeat(nloci, nloci)
+    if max_loci is not None:
+        ends = numpy.minimum(ends, numpy.arange(nloci) + max_loci + 1)
+    if max_bp is not None:
+        positions = numpy.asarray(positions)
+        if len(positions) != nloci:
+            raise GenomicsException('There should be one position per locus')
+        if numpy.any(numpy.diff(positions) < 0):
+            raise GenomicsException('Positions have to be sorted')
+        ends = numpy.minimum(ends, numpy.searchsorted(
+            positions, positions + max_bp, side='right'))
+    return ends
+
+
+def iter_burrows_delta_band(indlist, max_loci=None, max_bp=None,
+                            positions=None, batch_size=256, weights=None):
+    """Streams Burrows delta for pairs of loci that are close.
+
+    Parameters:
+        - indlist - List with a pair per individual (see calc_burrows_delta)
+          or the genotype matrix returned by encode_genotypes
+        - max_loci - Maximum distance in number of loci
+        - max_bp - Maximum distance in base pairs (requires positions)
+        - positions - Sorted position of each locus
+        - batch_size - Number of loci processed at once
+        - weights - Optional weight of each individual
+
+    Only pairs within both distances (if both are given) are computed, so
+    time and memory grow linearly with the number of loci.
+
+    Returns:
+        A generator of (i, j, delta) arrays, one triple per batch, with
+        i < j and pairs ordered as in calc_burrows_delta
 
+    >>> indlist = [('000', '001'), ('011', '111')]
+    >>> for i, j, delta in iter_burrows_delta_band(indlist, max_loci=1):
+    ...     print(i.tolist(), j.tolist(), delta.tolist())
+    [0, 1] [1, 2] [0.25, 0.25]
     """
-    nloci = len(indlist[0][0])
-    output = []
-    for i in range(nloci - 1):
-        indp = [(ind[0][i], ind[1][i]) for ind in indlist]
-        for j in range(i + 1, nloci):
-            indq = [(ind[0][j], ind[1][j]) for ind in indlist]
-            output.append(_calc_burrows_pair(indp, indq))
-    return output
+    dosage, observed, weights = _get_burrows_inputs(indlist, weights)
+    nloci = dosage.shape[1]
+    ends = _get_band_ends(nloci, max_loci, max_bp, positions)
+    for start in range(0, nloci - 1, batch_size):
+        end = min(start + batch_size, nloci - 1)
+        col_end = ends[start:end].max()
+        block = _burrows_block(dosage, slice(start, end),
+                               slice(start, col_end), observed, weights)
+        rows = numpy.arange(start, end)[:, None]
+        cols = numpy.arange(start, col_end)[None, :]
+        in_band = (cols > rows) & (cols < ends[start:end, None])
+        block_i, block_j = numpy.nonzero(in_band)
+        yield (block_i + start, block_j + start,
+               block[block_i, block_j])
+
+
+def calc_burrows_delta_band(indlist, max_loci=None, max_bp=None,
+                            positions=None, batch_size=256, weights=None):
+    """Burrows delta for pairs of loci that are close as a sparse matrix.
+
+    Parameters are as in iter_burrows_delta_band.
+
+    Returns:
+        A scipy.sparse COO matrix (loci x loci) with the pairs in the upper
+        triangle
+    """
+    from scipy import sparse
+    nloci = _as_geno(indlist).shape[1]
+    triples = list(iter_burrows_delta_band(indlist, max_loci, max_bp,
+                                           positions, batch_size, weights))
+    if len(triples) == 0:
+        return sparse.coo_matrix((nloci, nloci))
+    i, j, delta = [numpy.concatenate(x) for x in zip(*triples)]
+    return sparse.coo_matrix((delta, (i, j)), shape=(nloci, nloci))
+
+
+_POPCOUNT = numpy.array([bin(x).count('1') for x in range(256)],
+                        dtype=numpy.uint8)
+
+
+def _popcount_rows(bits):
+    """Number of set bits in each row of a packed bit array."""
+    if hasattr(numpy, 'bitwise_count'):
+        return numpy.bitwise_count(bits).sum(axis=-1, dtype=numpy.int64)
+    return _POPCOUNT[bits].sum(axis=-1, dtype=numpy.int64)
+
+
+def _pair_popcounts(rows, cols):
+    """Set bits shared by each row of rows with each row of cols."""
+    counts = numpy.empty((len(rows), len(cols)), dtype=numpy.int64)
+    for i in range(len(rows)):
+        counts[i] = _popcount_rows(rows[i] & cols)
+    return counts
+
+
+def _get_biallelic(indlist):
+    geno = _as_geno(indlist)
+    if geno.max() > 1:
+        raise GenomicsException('Only biallelic loci are supported')
+    return geno
+
+
+def _pack_dosages(dosage, observed=None):
+    """Bit packs (individuals x loci) dosages of biallelic loci.
+
+    Returns the packed planes (dosage >= 1 and dosage == 2, one row per
+    locus), the per locus sums of x and x ** 2 and the packed mask of
+    observed genotypes (None if there is no missing data).
+    """
+    if observed is not None:
+        dosage = dosage * observed
+    planes = [numpy.packbits((dosage >= 1).T, axis=1),
+              numpy.packbits((dosage == 2).T, axis=1)]
+    counts = [_popcount_rows(plane) for plane in planes]
+    mask = None
+    if observed is not None:
+        mask = numpy.packbits(numpy.asarray(observed, dtype=bool).T, axis=1)
+    return planes, counts[0] + counts[1], counts[0] + 3 * counts[1], mask
+
+
+def _select_packed(packed, loci):
+    """Packed dosages of a subset of loci."""
+    planes, sx, sxx, mask = packed
+    return ([plane[loci] for plane in planes], sx[loci], sxx[loci],
+            None if mask is None else mask[loci])
+
+
+def _genotype_r2_block(rows, cols, nind):
+    """Squared correlation of dosages between two sets of packed loci.
+
+    With missing data only individuals observed at both loci are used.
+    """
+    row_planes, sx, sxx, row_mask = rows
+    col_planes, sy, syy, col_mask = cols
+    sxy = sum(_pair_popcounts(row_plane, col_plane)
+              for row_plane in row_planes for col_plane in col_planes)
+    if row_mask is None:
+        n = nind
+        sx, sxx = sx[:, None], sxx[:, None]
+        sy, syy = sy[None, :], syy[None, :]
+    else:
+        n = _pair_popcounts(row_mask, col_mask)
+        c1, c2 = [_pair_popcounts(plane, col_mask) for plane in row_planes]
+        sx, sxx = c1 + c2, c1 + 3 * c2
+        c1, c2 = [_pair_popcounts(row_mask, plane) for plane in col_planes]
+        sy, syy = c1 + c2, c1 + 3 * c2
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        cov = sxy / n - sx * sy / n ** 2
+        return cov ** 2 / ((sxx / n - (sx / n) ** 2) *
+                           (syy / n - (sy / n) ** 2))
+
+
+def calc_genotype_r2(indlist, batch_size=256):
+    """Genotype correlation r2 for all pairs of biallelic loci.
+
+    Parameters:
+        - indlist - List with a pair per individual (see calc_burrows_delta)
+          or the genotype matrix returned by encode_genotypes
+        - batch_size - Number of loci compared against all others at once
+
+    Phase is not needed: r2 is the squared correlation of the allele
+    counts of individuals, computed by popcount over bit packed
+    genotypes. Each pair only uses individuals observed at both loci.
+    Monomorphic loci give nan.
+
+    Returns:
+        A condensed array in the same order as calc_burrows_delta
+
+    >>> calc_genotype_r2([('00', '00'), ('01', '01'), ('11', '11')])
+    array([0.25])
+    """
+    geno = _get_biallelic(indlist)
+    dosage = _get_dosages(geno)
+    packed = _pack_dosages(dosage, _get_observed(geno))
+    return _calc_condensed(
+        lambda rows, cols: (_genotype_r2_block(
+            _select_packed(packed, rows), _select_packed(packed, cols),
+            dosage.shape[0]),),
+        dosage.shape[1], batch_size)[0]
+
+
+def calc_haplotype_ld(indlist, batch_size=256):
+    """Haplotype r2 and D' for all pairs of phased biallelic loci.
+
+    Parameters:
+        - indlist - List with a pair per individual (see calc_burrows_delta)
+          where each element of the pair is a haplotype, or the genotype
+          matrix returned by encode_genotypes
+        - batch_size - Number of loci compared against all others at once
+
+    D' is signed (D / Dmax) and refers to the smallest allele of each
+    locus. Each pair only uses haplotypes known at both loci. Monomorphic
+    loci give nan.
+
+    Returns:
+        Condensed arrays of r2 and D' in the same order as
+        calc_burrows_delta
+
+    >>> calc_haplotype_ld([('00', '00'), ('01', '11')])
+    (array([0.33333333]), array([1.]))
+    """
+    geno = _get_biallelic(indlist)
+    haps = numpy.concatenate([geno[:, :, 0], geno[:, :, 1]]).T
+    known = numpy.packbits(haps >= 0, axis=1)
+    haps = numpy.packbits(haps == 0, axis=1)
+
+    def block_fun(rows, cols):
+        n = _pair_popcounts(known[rows], known[cols])
+        pa = _pair_popcounts(haps[rows], known[cols]) / n
+        pb = _pair_popcounts(known[rows], haps[cols]) / n
+        d = _pair_popcounts(haps[rows], haps[cols]) / n - pa * pb
+        d_max = numpy.where(d > 0,
+                            numpy.minimum(pa * (1 - pb), (1 - pa) * pb),
+                            numpy.minimum(pa * pb, (1 - pa) * (1 - pb)))
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return (d ** 2 / (pa * (1 - pa) * pb * (1 - pb)),
+                    d / d_max)
+    return tuple(_calc_condensed(block_fun, geno.shape[1], batch_size))
+
+
+def _burrows_tile(tile_dir, out_file, row_start, row_end,
+                  col_start, col_end):
+    """Writes Burrows delta for a tile of the pair matrix into out_file."""
+    inputs = {}
+    for name in ['dosage', 'observed', 'weights']:
+        fname = os.path.join(tile_dir, name + '.npy')
+        if os.path.exists(fname):
+            inputs[name] = numpy.load(fname, mmap_mode='r')
+    output = numpy.load(out_file, mmap_mode='r+')
+    nloci = inputs['dosage'].shape[1]
+    block = _burrows_block(inputs['dosage'], slice(row_start, row_end),
+                           slice(col_start, col_end),
+                           inputs.get('observed'), inputs.get('weights'))
+    for i in range(row_start, row_end):
+        first = max(i + 1, col_start)
+        if first >= col_end:
+            continue
+        offset = _condensed_offset(i, nloci) + first - i - 1
+        output[offset:offset + col_end - first] = \
+            block[i - row_start, first - col_start:]
+    output.flush()
+    del output
+    open(_get_done_marker(tile_dir, row_start, col_start), 'w').close()
+
+
+def _get_done_marker(tile_dir, row_start, col_start):
+    return os.path.join(tile_dir, 'done-%d-%d' % (row_start, col_start))
+
+
+def _get_tiles(nloci, tile_size):
+    for row_start in range(0, nloci - 1, tile_size):
+        row_end = min(row_start + tile_size, nloci - 1)
+        for col_start in range(row_start, nloci, tile_size):
+            yield (row_start, row_end, col_start,
+                   min(col_start + tile_size, nloci))
+
+
+def calc_burrows_delta_parallel(indlist, out_file, tile_size=1024,
+                                processes=None, executor=None,
+                                weights=None):
+    """Calculates Burrows delta for all pairs of loci in parallel.
+
+    Parameters:
+        - indlist - List with a pair per individual (see calc_burrows_delta)
+          or the genotype matrix returned by encode_genotypes
+        - out_file - .npy file where the condensed output is written
+        - tile_size - Number of loci per side of each tile of pairs
+        - processes - Size of the process pool (default: all CPUs)
+        - executor - Optional genomics.parallel executor. Each tile becomes
+          a job and the files have to be visible to every job
+        - weights - Optional weight of each individual
+
+    The pair matrix is cut in tiles that workers compute independently.
+    Input genotypes are shared through a .npy file in the configured
+    mr_dir and each worker writes directly to the memory mapped output,
+    so nothing large is sent back to the parent. Each finished tile
+    leaves a marker file, a GenomicsException is raised if any tile did
+    not finish (e.g. a failed executor job).
+
+    Returns:
+        A read only memory map of out_file with the same values and
+        order as calc_burrows_delta
+    """
+    dosage, observed, weights = _get_burrows_inputs(indlist, weights)
+    nloci = dosage.shape[1]
+    output = numpy.lib.format.open_memmap(
+        out_file, mode='w+', dtype=numpy.float64,
+        shape=(nloci * (nloci - 1) // 2,))
+    output[:] = numpy.nan
+    del output
+    tile_dir = tempfile.mkdtemp(dir=genomics.cfg.mr_dir)
+    try:
+        for name, data in [('dosage', dosage), ('observed', observed),
+                           ('weights', weights)]:
+            if data is not None:
+                numpy.save(os.path.join(tile_dir, name + '.npy'), data)
+        del dosage, observed
+        tiles = list(_get_tiles(nloci, tile_size))
+        if executor is None:
+            pool = multiprocessing.Pool(processes)
+            pool.starmap(_burrows_tile,
+                         [(tile_dir, out_file) + tile for tile in tiles])
+            pool.close()
+            pool.join()
+        else:
+            for tile in tiles:
+                executor.submit(
+                    '%s -m genomics.popgen.stats.ld' %
+                    shlex.quote(sys.executable),
+                    ' '.join([shlex.quote(tile_dir), shlex.quote(out_file)] +
+                             [str(x) for x in tile]))
+            executor.wait(for_all=True)
+        failed = [tile for tile in tiles
+                  if not os.path.exists(_get_done_marker(tile_dir, tile[0],
+                                                         tile[2]))]
+        if len(failed) > 0:
+            raise GenomicsException(
+                '%d of %d Burrows delta tiles failed (first: %s)' %
+                (len(failed), len(tiles), str(failed[0])))
+    finally:
+        shutil.rmtree(tile_dir)
+    return numpy.load(out_file, mmap_mode='r')
+
 
 if __name__ == "__main__":
-    print (calc_burrows_delta([('3a', '3a'), ('3b', '3a')]))
+    # Worker for calc_burrows_delta_parallel executor jobs
+    _burrows_tile(sys.argv[1], sys.argv[2],
+                  *[int(x) for x in sys.argv[3:7]])
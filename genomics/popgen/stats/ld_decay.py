@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: ld_decay
+   :synopsis: Linkage disequilibrium decay with distance
+
+.. moduleauthor:: Tiago Antao <tra@popgen.net>
+
+"""
+import math
+
+import numpy
+
+from genomics import GenomicsException
+
+
+class LDDecay(object):
+    """Accumulates LD values of pairs of loci into distance bins.
+
+    Parameters:
+        - positions - Position of each locus
+        - bin_size - Size of each distance bin
+        - max_distance - Pairs further apart are ignored
+        - value_range - Minimum and maximum LD value (for quantiles)
+        - resolution - Number of quantile sketch cells per bin
+
+    Values are added incrementally (e.g. per batch from
+    genomics.popgen.stats.ld.iter_burrows_delta_band, or from the output
+    of calc_burrows_delta_parallel) and are not stored. Each bin keeps a
+    count, a sum and a fixed histogram over value_range from which
+    quantiles are estimated with a precision of
+    (max - min) / resolution. nan values are ignored, values outside
+    value_range raise a GenomicsException (use e.g. (-1, 1) for signed
+    statistics like Burrows delta or D').
+
+    >>> decay = LDDecay([0, 10, 25, 40], 20, 100)
+    >>> decay.add_condensed([1.0, 0.5, 0.2, 0.8, 0.4, 0.6])
+    >>> decay.get_counts().tolist()
+    [3, 2, 1, 0, 0]
+    >>> decay.get_means().round(2).tolist()[:2]
+    [0.8, 0.45]
+    """
+    def __init__(self, positions, bin_size, max_distance,
+                 value_range=(0.0, 1.0), resolution=1000):
+        self.positions = numpy.asarray(positions)
+        self.bin_size = bin_size
+        self.max_distance = max_distance
+        self.value_range = value_range
+        self.resolution = resolution
+        self.nbins = int(math.ceil(max_distance / bin_size))
+        self._counts = numpy.zeros(self.nbins, dtype=numpy.int64)
+        self._sums = numpy.zeros(self.nbins)
+        self._sketch = numpy.zeros((self.nbins, resolution),
+                                   dtype=numpy.int64)
+
+    def add(self, distances, values):
+        """Adds LD values with the distance between their loci."""
+        distances = numpy.abs(numpy.asarray(distances))
+        values = numpy.asarray(values, dtype=numpy.float64)
+        keep = ~numpy.isnan(values) & (distances < self.max_distance)
+        bins = (distances[keep] // self.bin_size).astype(numpy.int64)
+        values = values[keep]
+        low, high = self.value_range
+        slack = 1e-9 * (high - low)  # Rounding, e.g. r2 of 1.0000000001
+        if numpy.any((values < low - slack) | (values > high + slack)):
+            raise GenomicsException(
+                'LD values from %g to %g are outside value_range %s' %
+                (values.min(), values.max(), str(self.value_range)))
+        self._counts += numpy.bincount(bins, minlength=self.nbins)
+        self._sums += numpy.bincount(bins, weights=values,
+                                     minlength=self.nbins)
+        cells = numpy.clip(((values - low) / (high - low) *
+                            self.resolution).astype(numpy.int64),
+                           0, self.resolution - 1)
+        self._sketch += numpy.bincount(
+            bins * self.resolution + cells,
+            minlength=self.nbins * self.resolution).reshape(
+                self.nbins, self.resolution)
+
+    def add_pairs(self, i, j, values):
+        """Adds LD values of the pairs of loci with indexes i and j."""
+        self.add(self.positions[j] - self.positions[i], values)
+
+    def add_condensed(self, values, batch_size=2 ** 20):
+        """Adds a condensed array of LD values for all pairs of loci.
+
+        Only the pairs within max_distance are read, so values can be
+        a memory map. The bands of consecutive loci are added in batches
+        of about batch_size values.
+        """
+        values = numpy.asarray(values)
+        nloci = len(self.positions)
+        if nloci < 2:
+            return
+        first = numpy.arange(nloci - 1)
+        ends = numpy.searchsorted(self.positions,
+                                  self.positions[first] + self.max_distance)
+        lengths = numpy.maximum(ends, first + 1) - first - 1
+        offsets = first * nloci - first * (first + 1) // 2
+        total = numpy.cumsum(lengths)
+        start = 0
+        while start < nloci - 1:
+            base = total[start - 1] if start > 0 else 0
+            end = numpy.searchsorted(total, base + batch_size, 'right')
+            end = min(max(end, start + 1), nloci - 1)
+            loci = first[start:end]
+            sizes = lengths[start:end]
+            # Position of each pair within the band of its first locus
+            band = numpy.arange(sizes.sum()) - numpy.repeat(
+                numpy.cumsum(sizes) - sizes, sizes)
+            i = numpy.repeat(loci, sizes)
+            self.add(self.positions[i + band + 1] - self.positions[i],
+                     values[numpy.repeat(offsets[start:end], sizes) + band])
+            start = end
+
+    def get_bin_centers(self):
+        return (numpy.arange(self.nbins) + 0.5) * self.bin_size
+
+    def get_counts(self):
+        return self._counts.copy()
+
+    def get_means(self):
+        """Mean LD per bin (nan for empty bins)."""
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return self._sums / self._counts
+
+    def get_quantiles(self, q):
+        """Estimated q quantile (0 to 1) per bin (nan for empty bins)."""
+        low, high = self.value_range
+        cumulative = numpy.cumsum(self._sketch, axis=1)
+        target = numpy.maximum(numpy.ceil(q * self._counts), 1)
+        cells = (cumulative < target[:, None]).sum(axis=1)
+        quantiles = low + (cells + 0.5) * (high - low) / self.resolution
+        return numpy.where(self._counts > 0, quantiles, numpy.nan)
+
+    def get_percentile_data(self, points=100):
+        """Pairs of x, y to feed genomics.plot.plot_percentile.
+
+        Each non empty bin is represented by points quantiles placed at
+        the center of the bin, use bin_size as wsize and wstep.
+        """
+        quantiles = [self.get_quantiles((k + 0.5) / points)
+                     for k in range(points)]
+        data = []
+        for bin_, x in enumerate(self.get_bin_centers()):
+            if self._counts[bin_] == 0:
+                continue
+            data.extend([(x, quantile[bin_]) for quantile in quantiles])
+        return data
+
+    def plot(self, ax, **kwargs):
+        """Plots the decay with genomics.plot.plot_percentile."""
+        from genomics.plot import plot_percentile
+        plot_percentile(ax, self.get_percentile_data(), self.bin_size,
+                        self.bin_size, **kwargs)
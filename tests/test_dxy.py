@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+import random
+
+from genomics.popgen.stats import dxy
+
+
+def _pi_XY_pairs(seq_freq1, seq_freq2):
+    nposes = dxy.get_n_poses(list(seq_freq1) + list(seq_freq2))
+    pi_XY = 0.0
+    for seq1, f1 in seq_freq1.items():
+        seq1 = ''.join([x for i, x in enumerate(seq1) if i not in nposes])
+        for seq2, f2 in seq_freq2.items():
+            seq2 = ''.join([x for i, x in enumerate(seq2)
+                            if i not in nposes])
+            pi_XY += f1 * f2 * dxy.calc_num_diffs(seq1, seq2) / len(seq1)
+    return pi_XY, len(seq1)
+
+
+def _random_seqs(rnd, nseqs, length, alphabet='ACGT', n_rate=0.0):
+    base = [rnd.choice(alphabet) for i in range(length)]
+    seqs = []
+    for i in range(nseqs):
+        seq = [x if rnd.random() > 0.2 else rnd.choice(alphabet)
+               for x in base]
+        seqs.append(''.join(['N' if rnd.random() < n_rate else x
+                             for x in seq]))
+    return seqs
+
+
+def test_pi_XY_matches_pairs():
+    rnd = random.Random(3)
+    for n_rate in [0.0, 0.01]:
+        freqs1 = dxy.calc_seq_freqs(_random_seqs(rnd, 30, 50, n_rate=n_rate))
+        freqs2 = dxy.calc_seq_freqs(_random_seqs(rnd, 20, 50, n_rate=n_rate))
+        pi_XY, lseq = dxy.calc_pi_XY(freqs1, freqs2)
+        exp_pi_XY, exp_lseq = _pi_XY_pairs(freqs1, freqs2)
+        assert abs(pi_XY - exp_pi_XY) < 1e-12
+        assert lseq == exp_lseq
+        d_XY, (pi_XY, pi1, pi2, lseq) = dxy.calc_d_XY(freqs1, freqs2,
+                                                      30, 20)
+        assert abs(pi1 - 30 / 29 * _pi_XY_pairs(freqs1, freqs1)[0]) < 1e-12
+
+
+def test_scan_windows():
+    import tempfile
+    import numpy
+    from genomics.db import DB, GenomeSchema
+    from genomics.organism import Genome
+    rnd = random.Random(5)
+    seqs1 = _random_seqs(rnd, 12, 200, n_rate=0.01)
+    seqs2 = _random_seqs(rnd, 9, 200, n_rate=0.01)
+    positions = sorted(rnd.sample(range(1, 5000), 200))
+    wins = dxy.scan_windows(dxy.encode_haplotypes(seqs1),
+                            dxy.encode_haplotypes(seqs2),
+                            positions, 500, 250)
+    for i, start in enumerate(wins['start']):
+        cols = [j for j, pos in enumerate(positions)
+                if start <= pos < start + 500]
+        win1 = [''.join([seq[j] for j in cols]) for seq in seqs1]
+        win2 = [''.join([seq[j] for j in cols]) for seq in seqs2]
+        d_XY, (pi_XY, pi1, pi2, lseq) = dxy.calc_d_XY(
+            dxy.calc_seq_freqs(win1), dxy.calc_seq_freqs(win2), 12, 9)
+        assert wins['nsites'][i] == lseq
+        assert numpy.allclose([wins[x][i] for x in
+                               ['d_XY', 'pi_XY', 'pi1', 'pi2']],
+                              [d_XY, pi_XY, pi1, pi2])
+    genome = Genome('Test', 'T', 1, 'Test genome')
+    genome.add_chrom('1', (4999, None))
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DB(tmp, GenomeSchema(1000, float, genome), True)
+        dxy.write_windows(db, '1', wins)
+        stored = [(key.position, value) for key, value in db.get_values()]
+    assert [pos for pos, value in stored] == wins['start'].tolist()
+    assert numpy.allclose([value for pos, value in stored], wins['d_XY'])
+
+
+def test_d_XY_matrix():
+    rnd = random.Random(7)
+    pops = [_random_seqs(rnd, 10 + i, 60, n_rate=0.002) for i in range(5)]
+    cache = dxy.HaplotypeDistanceCache()
+    d_XY, pi_XY, pis = dxy.calc_d_XY_matrix(pops, cache)
+    for i in range(5):
+        for j in range(i + 1, 5):
+            exp_d_XY, (exp_pi_XY, pi1, pi2, lseq) = dxy.calc_d_XY(
+                dxy.calc_seq_freqs(pops[i]), dxy.calc_seq_freqs(pops[j]),
+                len(pops[i]), len(pops[j]))
+            assert abs(d_XY[i, j] - exp_d_XY) < 1e-12
+            assert abs(d_XY[j, i] - exp_d_XY) < 1e-12
+            assert abs(pi_XY[i, j] - exp_pi_XY) < 1e-12
+            assert abs(pis[i] - pi1) < 1e-12
+            assert abs(pis[j] - pi2) < 1e-12
+    # 5 within and 10 between population matrices
+    assert len(cache) == 15
+    dxy.calc_d_XY_matrix(pops[:3], cache)
+    assert len(cache) == 15
+
+
+def test_d_XY_stream():
+    import os
+    import tempfile
+    rnd = random.Random(9)
+    pops = [_random_seqs(rnd, 4 + i, 157, n_rate=0.01) for i in range(3)]
+    sample_pop = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, 'aln.fa')
+        w = open(fname, 'w')
+        w.write('>outgroup\n%s\n' % ('A' * 157))
+        for pop, seqs in enumerate(pops):
+            for i, seq in enumerate(seqs):
+                name = 'p%d_%d' % (pop, i)
+                sample_pop[name] = 'pop%d' % pop
+                w.write('>%s description\n' % name)
+                for start in range(0, 157, 60):
+                    w.write(seq[start:start + 60] + '\n')
+        w.close()
+        reader = dxy.FastaColumnReader(fname)
+        assert reader.length == 157
+        block = reader.get_block(55, 125, ['p1_2'])
+        assert block.tobytes().decode() == pops[1][2][55:125]
+        for block_size in [7, 60, 1000]:
+            res = dxy.calc_d_XY_stream(fname, sample_pop, block_size)
+            for pop1, pop2 in [(0, 1), (0, 2), (1, 2)]:
+                exp = dxy.calc_d_XY(dxy.calc_seq_freqs(pops[pop1]),
+                                    dxy.calc_seq_freqs(pops[pop2]),
+                                    len(pops[pop1]), len(pops[pop2]))
+                d_XY, rest = res['pop%d' % pop1, 'pop%d' % pop2]
+                assert abs(d_XY - exp[0]) < 1e-12
+                assert all([abs(x - y) < 1e-12
+                            for x, y in zip(rest, exp[1])])
+
+
+def test_resampling():
+    import numpy
+    rnd = random.Random(21)
+    seqs1 = _random_seqs(rnd, 15, 300, n_rate=0.005)
+    seqs2 = _random_seqs(rnd, 12, 300, n_rate=0.005)
+    haps1 = dxy.encode_haplotypes(seqs1)
+    haps2 = dxy.encode_haplotypes(seqs2)
+    d_XY, (pi_XY, pi1, pi2, lseq) = dxy.calc_d_XY(
+        dxy.calc_seq_freqs(seqs1), dxy.calc_seq_freqs(seqs2), 15, 12)
+    boot = dxy.bootstrap_d_XY(haps1, haps2, 20, replicates=250, seed=1,
+                              chunk_size=60)
+    assert boot == dxy.bootstrap_d_XY(haps1, haps2, 20, replicates=250,
+                                      seed=1, processes=2, chunk_size=60)
+    jack = dxy.jackknife_d_XY(haps1, haps2, 20)
+    for res in [boot, jack]:
+        for name, value in [('d_XY', d_XY), ('pi_XY', pi_XY),
+                            ('pi1', pi1), ('pi2', pi2)]:
+            estimate, low, high = res[name]
+            assert abs(estimate - value) < 1e-12
+            assert low < estimate < high
+    # Leaving out one block is the same as dropping its sites
+    sums = dxy.calc_block_sums(haps1, haps2, 20)
+    total = sums.sum(axis=0) - sums[3]
+    keep = [i for i in range(300) if not 60 <= i < 80]
+    cut1 = [''.join([seq[i] for i in keep]) for seq in seqs1]
+    cut2 = [''.join([seq[i] for i in keep]) for seq in seqs2]
+    exp = dxy.calc_d_XY(dxy.calc_seq_freqs(cut1), dxy.calc_seq_freqs(cut2),
+                        15, 12)
+    assert numpy.isclose(dxy._d_XY_from_sums(total[None, :], 15, 12)[0][0],
+                         exp[0])
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import tempfile
+
+import numpy
+
+_GENEPOP = '''Title line
+loc1, loc2
+loc3
+POP
+ind1, 0101 0203 0000
+ind2, 0102 0303 0401
+Pop
+ind3, 0202 0003 0101
+
+POP
+ind4, 0101 0103 0102
+'''
+
+
+def test_record_iterator():
+    from genomics.popgen.genepop.parser import read
+    record = read(io.StringIO(_GENEPOP))
+    assert record.loci_list == ['loc1', 'loc2', 'loc3']
+    assert record.marker_len == 2
+    recs = list(record)
+    assert recs[0] == ()
+    assert recs[1] == ('ind1', [(1, 1), (2, 3), (None, None)])
+    assert recs[3] == ()
+    assert recs[4] == ('ind3', [(2, 2), (None, 3), (1, 1)])
+    assert [rec[0] if rec != () else () for rec in recs] == \
+        [(), 'ind1', 'ind2', (), 'ind3', (), 'ind4']
+    record = read(io.StringIO(_GENEPOP))
+    assert next(record) == ()
+    assert next(record)[0] == 'ind1'
+
+
+def test_record_batches():
+    from genomics.popgen.genepop.parser import read
+    record = read(io.StringIO(_GENEPOP))
+    batches = list(record.iter_batches(1))
+    assert [(pop, names) for pop, names, alleles in batches] == \
+        [(0, ['ind1']), (0, ['ind2']), (1, ['ind3']), (2, ['ind4'])]
+    record = read(io.StringIO(_GENEPOP))
+    pop, names, alleles = next(record.iter_batches())
+    assert names == ['ind1', 'ind2']
+    assert alleles.shape == (2, 3, 2)
+    assert alleles[0].tolist() == [[1, 1], [2, 3], [0, 0]]
+
+
+def test_to_smartpca():
+    from genomics.popgen.genepop.convert import to_smartpca
+    ind_w, snp_w, geno_w = io.StringIO(), io.StringIO(), io.StringIO()
+    ind_w.close = snp_w.close = geno_w.close = lambda: None
+    to_smartpca(io.StringIO(_GENEPOP), ind_w, snp_w, geno_w)
+    assert ind_w.getvalue().split('\n')[0] == 'ind1 U Case'
+    assert snp_w.getvalue().split('\n')[0] == 'loc1-1 1 0.0 1'
+    assert geno_w.getvalue().split('\n')[0] == '1101'
+
+
+def test_read_array():
+    from genomics import GenomicsException
+    from genomics.popgen.genepop.parser import read, read_array
+    record, genotypes, pops, names = read_array(io.StringIO(_GENEPOP),
+                                                batch_size=1)
+    assert genotypes.dtype == numpy.uint16
+    assert genotypes.shape == (4, 3, 2)
+    assert pops.tolist() == [0, 0, 1, 2]
+    assert names.tolist() == ['ind1', 'ind2', 'ind3', 'ind4']
+    recs = [rec for rec in read(io.StringIO(_GENEPOP)) if rec != ()]
+    for rec, alleles in zip(recs, genotypes):
+        assert [tuple(x or 0 for x in locus) for locus in rec[1]] == \
+            [tuple(locus) for locus in alleles.tolist()]
+    three = 'T\nl1\nl2\nPOP\na, 120\t001\nb,  000 \t 999\n'
+    record, genotypes, pops, names = read_array(io.StringIO(three))
+    assert record.marker_len == 3
+    assert genotypes.shape == (2, 2, 1)
+    assert genotypes[:, :, 0].tolist() == [[120, 1], [0, 999]]
+    try:
+        read_array(io.StringIO(_GENEPOP.replace('0401', '04')))
+        assert False
+    except GenomicsException:
+        pass
+
+
+def test_write_genepop():
+    from genomics.popgen.genepop.convert import write_genepop
+    from genomics.popgen.genepop.parser import read_array
+    record, genotypes, pops, names = read_array(io.StringIO(_GENEPOP))
+    w = io.StringIO()
+    write_genepop(w, genotypes, pops, names, record.loci_list,
+                  record.comment_line, batch_size=1)
+    copy = read_array(io.StringIO(w.getvalue()))
+    assert (copy[1] == genotypes).all()
+    assert copy[2].tolist() == pops.tolist()
+    assert copy[3].tolist() == names.tolist()
+    assert w.getvalue().split('\n')[5] == 'ind1, 0101 0203 0000'
+    w = io.StringIO()
+    write_genepop(w, genotypes, pops, names, record.loci_list,
+                  pops=[2, 0], marker_len=3)
+    assert w.getvalue().split('\n')[5:] == [
+        'ind4, 001001 001003 001002', 'POP',
+        'ind1, 001001 002003 000000', 'ind2, 001002 003003 004001', '']
+
+
+def test_genepop_index():
+    from genomics.popgen.genepop import parser
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, 'data.gp')
+        open(fname, 'w').write(_GENEPOP)
+        record, genotypes, pops, names = parser.read_array(open(fname))
+        index = parser.get_index(fname, every=2)
+        assert os.path.exists(fname + '.gpidx')
+        assert index.nindivs == 4
+        assert [cp[0] for cp in index.checkpoints] == [0, 2]
+        assert parser.read_index(fname + '.gpidx').pops == index.pops
+        pop_names, alleles = parser.read_population(fname, 1)
+        assert pop_names == ['ind3']
+        assert (alleles == genotypes[2:3]).all()
+        for start, end in [(0, 4), (1, 3), (3, 10)]:
+            range_pops, range_names, alleles = parser.read_individuals(
+                fname, start, end)
+            assert range_pops.tolist() == pops[start:end].tolist()
+            assert range_names == names[start:end].tolist()
+            assert (alleles == genotypes[start:end]).all()
+        open(fname, 'a').write('ind5, 0101 0101 0101\n')
+        assert parser.get_index(fname).nindivs == 5
+        assert parser.read_population(fname, 2)[0] == ['ind4', 'ind5']
+
+
+def test_genepop_index_stale():
+    from genomics.popgen.genepop import parser
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, 'data.gp')
+        open(fname, 'w').write(_GENEPOP)
+        parser.get_index(fname)
+        # Same size, different line boundaries
+        edited = _GENEPOP.replace('ind3', 'ind33').replace('ind4', 'in4')
+        assert len(edited) == len(_GENEPOP)
+        open(fname, 'w').write(edited)
+        stat = os.stat(fname)
+        os.utime(fname, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        parser._gp_indexes.clear()
+        assert parser.read_population(fname, 1)[0] == ['ind33']
+        assert parser.read_population(fname, 2)[0] == ['in4']
+
+        # An unwritable sidecar keeps the index in memory
+        other = os.path.join(tmp, 'other.gp')
+        open(other, 'w').write(_GENEPOP)
+        index = parser.get_index(other, index_fname=os.path.join(
+            tmp, 'missing', 'other.gpidx'))
+        assert index.nindivs == 4
+        assert parser.read_individuals(other, 3, 4, index)[1] == ['ind4']
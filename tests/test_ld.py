@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+import os
+import random
+import tempfile
+
+import numpy
+
+from genomics.popgen.stats import ld
+
+
+def _random_indlist(nind, nloci, alleles='abc', seed=0):
+    rnd = random.Random(seed)
+    return [(''.join(rnd.choice(alleles) for i in range(nloci)),
+             ''.join(rnd.choice(alleles) for i in range(nloci)))
+            for ind in range(nind)]
+
+
+def _burrows_pairs(indlist):
+    nloci = len(indlist[0][0])
+    # The reference is the smallest allele over all the individuals
+    refs = [min(ind[hap][i] for ind in indlist for hap in range(2)
+                if ind[hap][i] is not None) for i in range(nloci)]
+    output = []
+    for i in range(nloci - 1):
+        for j in range(i + 1, nloci):
+            known = [ind for ind in indlist
+                     if None not in (ind[0][i], ind[1][i],
+                                     ind[0][j], ind[1][j])]
+            output.append(ld._calc_burrows_pair(
+                [(ind[0][i], ind[1][i]) for ind in known],
+                [(ind[0][j], ind[1][j]) for ind in known],
+                refs[i], refs[j]))
+    return numpy.array(output)
+
+
+def test_burrows_array_matches_pairs():
+    for seed in range(10):
+        indlist = _random_indlist(5 + seed, 2 + seed, seed=seed)
+        expected = _burrows_pairs(indlist)
+        assert numpy.allclose(ld.calc_burrows_delta(indlist), expected)
+        for batch_size in [1, 3, 256]:
+            res = ld.calc_burrows_delta_array(indlist, batch_size)
+            assert numpy.allclose(res, expected)
+
+
+def test_burrows_band_matches_all_pairs():
+    indlist = _random_indlist(12, 15, seed=3)
+    all_pairs = ld.calc_burrows_delta_array(indlist)
+    positions = [10 * x * x for x in range(15)]
+    for max_loci, max_bp in [(1, None), (4, None), (None, 300), (3, 150)]:
+        for batch_size in [1, 4, 256]:
+            for i, j, delta in ld.iter_burrows_delta_band(
+                    indlist, max_loci, max_bp, positions, batch_size):
+                assert numpy.all(j > i)
+                if max_loci is not None:
+                    assert numpy.all(j - i <= max_loci)
+                if max_bp is not None:
+                    dists = numpy.take(positions, j) - numpy.take(positions, i)
+                    assert numpy.all(dists <= max_bp)
+                offsets = i * 15 - i * (i + 1) // 2 + j - i - 1
+                assert numpy.allclose(delta, all_pairs[offsets])
+    band = ld.calc_burrows_delta_band(indlist, max_loci=14)
+    assert numpy.allclose(band.toarray()[numpy.triu_indices(15, 1)],
+                          all_pairs)
+
+
+def test_burrows_parallel():
+    from genomics.parallel.executor import Local
+    indlist = _random_indlist(10, 23, seed=5)
+    expected = ld.calc_burrows_delta_array(indlist)
+    with tempfile.TemporaryDirectory() as tmp:
+        out_file = os.path.join(tmp, 'ld.npy')
+        res = ld.calc_burrows_delta_parallel(indlist, out_file,
+                                             tile_size=4, processes=2)
+        assert numpy.allclose(res, expected)
+        spaced_file = os.path.join(tmp, 'with space', 'ld.npy')
+        os.mkdir(os.path.dirname(spaced_file))
+        res = ld.calc_burrows_delta_parallel(indlist, spaced_file,
+                                             tile_size=10,
+                                             executor=Local(-2))
+        assert numpy.allclose(res, expected)
+
+
+class _FailingExecutor(object):
+    def submit(self, command, parameters):
+        pass
+
+    def wait(self, for_all=False):
+        pass
+
+
+def test_burrows_parallel_failure():
+    from genomics import GenomicsException
+    indlist = _random_indlist(10, 8, seed=5)
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            ld.calc_burrows_delta_parallel(indlist,
+                                           os.path.join(tmp, 'ld.npy'),
+                                           tile_size=4,
+                                           executor=_FailingExecutor())
+            assert False
+        except GenomicsException:
+            pass
+
+
+def test_biallelic_ld():
+    indlist = _random_indlist(40, 9, alleles='01', seed=7)
+    geno, alleles = ld.encode_genotypes(indlist)
+    dosage = (geno == 0).sum(axis=2)
+    haps = numpy.concatenate([geno[:, :, 0], geno[:, :, 1]]) == 0
+    expected_r2 = []
+    expected_hap_r2 = []
+    expected_dprime = []
+    for i in range(9):
+        for j in range(i + 1, 9):
+            expected_r2.append(
+                numpy.corrcoef(dosage[:, i], dosage[:, j])[0, 1] ** 2)
+            pa, pb = haps[:, i].mean(), haps[:, j].mean()
+            d = (haps[:, i] & haps[:, j]).mean() - pa * pb
+            expected_hap_r2.append(d ** 2 / (pa * (1 - pa) * pb * (1 - pb)))
+            if d > 0:
+                d_max = min(pa * (1 - pb), (1 - pa) * pb)
+            else:
+                d_max = min(pa * pb, (1 - pa) * (1 - pb))
+            expected_dprime.append(d / d_max)
+    for batch_size in [2, 256]:
+        assert numpy.allclose(ld.calc_genotype_r2(indlist, batch_size),
+                              expected_r2)
+        r2, dprime = ld.calc_haplotype_ld(indlist, batch_size)
+        assert numpy.allclose(r2, expected_hap_r2)
+        assert numpy.allclose(dprime, expected_dprime)
+
+
+def test_burrows_missing_and_weights():
+    rnd = random.Random(11)
+    indlist = [tuple([rnd.choice('ab') if rnd.random() > 0.1 else None
+                      for i in range(8)] for hap in range(2))
+               for ind in range(30)]
+    # Pairs only see the individuals known at both loci
+    nloci = 8
+    expected = _burrows_pairs(indlist)
+    assert numpy.allclose(ld.calc_burrows_delta_array(indlist, 3), expected)
+    for i, j, delta in ld.iter_burrows_delta_band(indlist, max_loci=2):
+        offsets = i * nloci - i * (i + 1) // 2 + j - i - 1
+        assert numpy.allclose(delta, expected[offsets])
+    # The reference allele does not depend on the order of individuals
+    assert numpy.allclose(ld.calc_burrows_delta_array(indlist[::-1]),
+                          expected)
+    # Integer weights are the same as repeating individuals
+    weights = [rnd.randint(1, 3) for ind in indlist]
+    repeated = [ind for ind, w in zip(indlist, weights) for i in range(w)]
+    assert numpy.allclose(
+        ld.calc_burrows_delta_array(indlist, weights=weights),
+        ld.calc_burrows_delta_array(repeated))
+    r2, n = ld.calc_burrows_r2(indlist, weights=weights)
+    r2_rep, n_rep = ld.calc_burrows_r2(repeated)
+    assert numpy.allclose(r2, r2_rep)
+    offset = 0
+    for i in range(nloci - 1):
+        for j in range(i + 1, nloci):
+            assert n[offset] == len([
+                ind for ind in indlist
+                if None not in (ind[0][i], ind[1][i], ind[0][j], ind[1][j])])
+            offset += 1
+
+
+def test_burrows_r2_complete():
+    indlist = _random_indlist(30, 7, seed=23)
+    delta = _burrows_pairs(indlist)
+    expected = []
+    offset = 0
+    for i in range(6):
+        for j in range(i + 1, 7):
+            # Weir (1979), for the smallest allele of each locus
+            variances = []
+            for loc in (i, j):
+                ref = min(ind[hap][loc] for ind in indlist for hap in (0, 1))
+                p = sum((ind[0][loc] == ref) + (ind[1][loc] == ref)
+                        for ind in indlist) / (2 * len(indlist))
+                h = sum(ind[0][loc] == ref == ind[1][loc]
+                        for ind in indlist) / len(indlist)
+                variances.append(p * (1 - p) + h - p ** 2)
+            expected.append(delta[offset] ** 2 /
+                            (variances[0] * variances[1]))
+            offset += 1
+    for batch_size in [2, 256]:
+        r2, n = ld.calc_burrows_r2(indlist, batch_size)
+        assert numpy.allclose(r2, expected)
+        assert numpy.all(n == 30)
+        r2, n = ld.calc_burrows_r2(indlist, batch_size,
+                                   weights=numpy.ones(30))
+        assert numpy.allclose(r2, expected)
+        assert numpy.all(n == 30)
+    geno, alleles = ld.encode_genotypes(indlist)
+    r2, n = ld.calc_burrows_r2(geno)
+    assert numpy.allclose(r2, expected)
+
+
+def test_biallelic_ld_missing():
+    rnd = random.Random(13)
+    indlist = [tuple([rnd.choice('01') if rnd.random() > 0.1 else None
+                      for i in range(6)] for hap in range(2))
+               for ind in range(40)]
+    r2 = ld.calc_genotype_r2(indlist)
+    hap_r2, dprime = ld.calc_haplotype_ld(indlist)
+    offset = 0
+    for i in range(5):
+        for j in range(i + 1, 6):
+            known = [ind for ind in indlist
+                     if None not in (ind[0][i], ind[1][i],
+                                     ind[0][j], ind[1][j])]
+            x = [(ind[0][i] == '0') + (ind[1][i] == '0') for ind in known]
+            y = [(ind[0][j] == '0') + (ind[1][j] == '0') for ind in known]
+            assert numpy.isclose(r2[offset], numpy.corrcoef(x, y)[0, 1] ** 2)
+            haps = [(hap[i], hap[j]) for ind in indlist for hap in ind
+                    if None not in (hap[i], hap[j])]
+            ha = numpy.array([hap[0] == '0' for hap in haps])
+            hb = numpy.array([hap[1] == '0' for hap in haps])
+            pa, pb = ha.mean(), hb.mean()
+            d = (ha & hb).mean() - pa * pb
+            assert numpy.isclose(hap_r2[offset],
+                                 d ** 2 / (pa * (1 - pa) * pb * (1 - pb)))
+            offset += 1
+    with tempfile.TemporaryDirectory() as tmp:
+        weights = [rnd.random() for ind in indlist]
+        res = ld.calc_burrows_delta_parallel(
+            indlist, os.path.join(tmp, 'ld.npy'), tile_size=2, processes=2,
+            weights=weights)
+        assert numpy.allclose(
+            res, ld.calc_burrows_delta_array(indlist, weights=weights))
+
+
+def test_ld_decay():
+    from genomics.popgen.stats.ld_decay import LDDecay
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+    rnd = random.Random(17)
+    positions = sorted(rnd.sample(range(10000), 60))
+    indlist = _random_indlist(25, 60, alleles='01', seed=17)
+    r2 = ld.calc_genotype_r2(indlist)
+    i, j = numpy.triu_indices(60, 1)
+    dists = numpy.take(positions, j) - numpy.take(positions, i)
+    decay = LDDecay(positions, 500, 3000)
+    decay.add_condensed(r2)
+    band = LDDecay(positions, 500, 3000)
+    for bi, bj, delta in ld.iter_burrows_delta_band(
+            indlist, max_bp=2999, positions=positions, batch_size=7):
+        band.add_pairs(bi, bj, r2[bi * 60 - bi * (bi + 1) // 2 + bj - bi - 1])
+    for bin_ in range(6):
+        values = r2[(dists >= bin_ * 500) & (dists < (bin_ + 1) * 500)]
+        values = values[~numpy.isnan(values)]
+        assert decay.get_counts()[bin_] == len(values)
+        assert band.get_counts()[bin_] == len(values)
+        assert numpy.isclose(decay.get_means()[bin_], values.mean())
+        assert abs(decay.get_quantiles(0.5)[bin_] -
+                   numpy.percentile(values, 50)) < 0.01
+    fig, ax = plt.subplots()
+    decay.plot(ax)
+
+
+def test_ld_decay_signed():
+    from genomics import GenomicsException
+    from genomics.popgen.stats.ld_decay import LDDecay
+    rnd = random.Random(19)
+    positions = sorted(rnd.sample(range(10000), 40))
+    indlist = _random_indlist(25, 40, alleles='01', seed=19)
+    delta = ld.calc_burrows_delta_array(indlist)
+    assert delta.min() < 0
+    try:
+        LDDecay(positions, 500, 3000).add_condensed(delta)
+        assert False
+    except GenomicsException:
+        pass
+    i, j = numpy.triu_indices(40, 1)
+    pairs = LDDecay(positions, 500, 3000, value_range=(-1, 1))
+    pairs.add_pairs(i, j, delta)
+    for batch_size in [1, 7, 2 ** 20]:
+        decay = LDDecay(positions, 500, 3000, value_range=(-1, 1))
+        decay.add_condensed(delta, batch_size)
+        assert numpy.array_equal(decay.get_counts(), pairs.get_counts())
+        assert numpy.allclose(decay.get_means(), pairs.get_means(),
+                              equal_nan=True)
+        assert numpy.array_equal(decay._sketch, pairs._sketch)
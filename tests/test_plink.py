@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import random
+import tempfile
+
+import numpy
+
+
+def _random_snp(rnd, nind, alleles='AG'):
+    return [rnd.choice(alleles) for i in range(2 * nind)]
+
+
+def test_ld_prune():
+    from genomics.popgen.plink.prune import ld_prune
+    rnd = random.Random(1)
+    snp1 = _random_snp(rnd, 30)
+    snp1[:2] = ['0', '0']
+    snps = [snp1, list(snp1), _random_snp(rnd, 30, 'CT'),
+            _random_snp(rnd, 30), ['A', 'C'] * 30, list(snp1)]
+    with tempfile.TemporaryDirectory() as tmp:
+        pref = os.path.join(tmp, 'test')
+        w = open(pref + '.tped', 'w')
+        for i, snp in enumerate(snps):
+            w.write('1 rs%d 0 %d %s\n' % (i, 100 * i, ' '.join(snp)))
+        w.close()
+        prune_in = os.path.join(tmp, 'prune.in')
+        assert ld_prune(pref, prune_in, window_size=4, threshold=0.5) == 5
+        assert open(prune_in).read().split() == ['rs0', 'rs2', 'rs3',
+                                                 'rs4', 'rs5']
+        ld_prune(pref, prune_in, window_size=10, window_bp=450,
+                 threshold=0.5)
+        assert open(prune_in).read().split() == ['rs0', 'rs2', 'rs3',
+                                                 'rs4', 'rs5']
+        ld_prune(pref, prune_in, window_size=10, threshold=0.5)
+        assert open(prune_in).read().split() == ['rs0', 'rs2', 'rs3',
+                                                 'rs4']
+
+
+def _write_plink(pref, fams, snps, genotypes):
+    '''Writes the same data as PED/MAP and as BED/BIM/FAM.
+
+    genotypes is SNP x individual with the A1 count (-1 is missing).
+    '''
+    pw = open(pref + '.ped', 'w')
+    for ind, fam in enumerate(fams):
+        toks = []
+        for snp, counts in zip(snps, genotypes):
+            a1, a2 = snp[4], snp[5]
+            toks.append({2: a1 + ' ' + a1, 1: a1 + ' ' + a2,
+                         0: a2 + ' ' + a2, -1: '0 0'}[counts[ind]])
+        pw.write('%s %s\n' % (' '.join(fam), ' '.join(toks)))
+    pw.close()
+    mw = open(pref + '.map', 'w')
+    bw = open(pref + '.bim', 'w')
+    for snp in snps:
+        mw.write('\t'.join(snp[:4]) + '\n')
+        bw.write('\t'.join(snp) + '\n')
+    mw.close()
+    bw.close()
+    fw = open(pref + '.fam', 'w')
+    fw.write(''.join(' '.join(fam) + '\n' for fam in fams))
+    fw.close()
+    codes = {2: 0, -1: 1, 1: 2, 0: 3}
+    bed = bytearray([0x6c, 0x1b, 0x01])
+    for counts in genotypes:
+        for start in range(0, len(counts), 4):
+            byte = 0
+            for i, count in enumerate(counts[start:start + 4]):
+                byte |= codes[count] << (2 * i)
+            bed.append(byte)
+    bw = open(pref + '.bed', 'wb')
+    bw.write(bytes(bed))
+    bw.close()
+
+
+def _make_plink(tmp, nind=7, nsnps=9, seed=3):
+    rnd = random.Random(seed)
+    fams = [['f%d' % (i % 2), 'i%d' % i, '0', '0', '1', '-9']
+            for i in range(nind)]
+    snps = [['1', 'rs%d' % i, '0', str(1000 * (i + 1)),
+             *rnd.choice(['AG', 'CT', 'GA', 'TC'])] for i in range(nsnps)]
+    genotypes = [[rnd.choice([-1, 0, 1, 1, 2]) for i in range(nind)]
+                 for snp in snps]
+    pref = os.path.join(tmp, 'data')
+    _write_plink(pref, fams, snps, genotypes)
+    return pref, fams, snps, genotypes
+
+
+def test_bed_reader():
+    from genomics.popgen.plink.bed import BedReader
+    with tempfile.TemporaryDirectory() as tmp:
+        pref, fams, snps, genotypes = _make_plink(tmp)
+        reader = BedReader(pref)
+        assert reader.nsamples == 7 and reader.nsnps == 9
+        assert reader.get_genotypes().tolist() == genotypes
+        assert reader.get_genotypes(2, 5, [6, 1]).tolist() == [
+            [counts[6], counts[1]] for counts in genotypes[2:5]]
+        alleles = reader.get_alleles(samples=[3])[0].tobytes().decode()
+        ped = open(pref + '.ped').readlines()[3].split()[6:]
+        assert list(alleles) == ped
+
+
+def test_convert_bed():
+    from genomics.popgen.plink import convert
+    with tempfile.TemporaryDirectory() as tmp:
+        pref, fams, snps, genotypes = _make_plink(tmp)
+        bed_pref = os.path.join(tmp, 'bed')
+        for ext in ['.bed', '.bim', '.fam']:
+            os.rename(pref + ext, bed_pref + ext)
+        outputs = {}
+        for name, my_pref in [('ped', pref), ('bed', bed_pref)]:
+            out = os.path.join(tmp, name)
+            convert.to_genepop(my_pref, out, {'p1': [('f0', 'i0'),
+                                                     ('f1', 'i3')],
+                                              'p2': [('f0', 'i2')]})
+            convert.to_ldhat(my_pref, out + '.sites', out + '.locs')
+            outputs[name] = [open(out + ext).read()
+                             for ext in ['.gp', '.sites', '.locs']]
+        assert outputs['ped'] == outputs['bed']
+        convert.to_eigen(bed_pref, os.path.join(tmp, 'eigen'))
+        geno = open(os.path.join(tmp, 'eigen.geno')).read().split()
+        assert geno == [''.join('9' if count < 0 else str(count)
+                                for count in counts)
+                        for counts in genotypes]
+
+
+def test_to_ldhat():
+    from genomics.popgen.plink.convert import to_ldhat
+    with tempfile.TemporaryDirectory() as tmp:
+        pref = os.path.join(tmp, 'data')
+        w = open(pref + '.ped', 'w')
+        w.write('f i1 0 0 1 -9 A G\tC C 0 0\n')
+        w.write('f i2 0 0 1 -9\tG G T C A A\n')
+        w.close()
+        w = open(pref + '.map', 'w')
+        w.write('1 rs1 0 1000\n1 rs2 0 2000\n1 rs3 0 3000\n')
+        w.close()
+        to_ldhat(pref, pref + '.sites', pref + '.locs')
+        # '0' (missing) is the smallest allele of the last locus
+        assert open(pref + '.sites').read() == \
+            '2 3 2\n>i1\n200\n>i2\n121\n'
+
+
+def test_to_eigen():
+    from genomics.popgen.plink import convert
+    with tempfile.TemporaryDirectory() as tmp:
+        pref, fams, snps, genotypes = _make_plink(tmp, nind=6)
+        for snp in snps:
+            snp[4:] = ['1', '2']
+        _write_plink(pref, fams, snps, genotypes)
+        expected = [''.join('9' if count < 0 else str(count)
+                            for count in counts) for counts in genotypes]
+        eigen = os.path.join(tmp, 'eigen')
+        convert.to_eigen(pref, eigen, max_memory=0)
+        assert open(eigen + '.geno').read().split() == expected
+        assert open(eigen + '.ind').readline() == 'f0/i0\tU\tControl\n'
+        assert open(eigen + '.snp').readline() == 'rs0\t1\t0.0\t1000\n'
+
+        convert.to_eigen(pref, eigen, packed=True)
+        packed = open(eigen + '.geno', 'rb').read()
+        assert len(packed) == 48 * (len(snps) + 1)
+        ihash = convert._hasharr(['f%d/i%d' % (i % 2, i) for i in range(6)])
+        shash = convert._hasharr([snp[1] for snp in snps])
+        assert packed[:48].rstrip(b'\0').decode() == \
+            'GENO %7d %7d %x %x' % (6, len(snps), ihash & 0xffffffff,
+                                    shash & 0xffffffff)
+        row = packed[48:50]
+        codes = [(row[i // 4] >> (6 - 2 * (i % 4))) & 3 for i in range(6)]
+        assert codes == [3 if count < 0 else count
+                         for count in genotypes[0]]
+        assert convert._hashit('ab') == 97 * 23 + 98
+        assert convert._hashit('z' * 10) < 0
+
+
+def test_to_genepop():
+    from genomics.popgen.plink.convert import to_genepop
+    with tempfile.TemporaryDirectory() as tmp:
+        pref = os.path.join(tmp, 'data')
+        w = open(pref + '.ped', 'w')
+        w.write('f i1 0 0 1 -9 A G C C\n')
+        w.write('f i2 0 0 1 -9 T G 0 N\n')
+        w.write('f i3 0 0 1 -9 A A C T\n')
+        w.close()
+        w = open(pref + '.map', 'w')
+        w.write('1 rs1 0 1000\n2 rs2 0 2000\n')
+        w.close()
+        out = os.path.join(tmp, 'out')
+        cwd_files = set(os.listdir('.'))
+        to_genepop(pref, out, {'b': [('f', 'i3'), ('f', 'i1')],
+                               'a': [('f', 'i2'), ('f', 'i1')],
+                               'c': []})
+        assert open(out + '.gp').read() == (
+            'plink2gp\n1/rs1/1000\n2/rs2/2000\n'
+            'POP\nf/i1, 0104 0202\nf/i2, 0304 0000\n'
+            'POP\nf/i1, 0104 0202\nf/i3, 0101 0203\n'
+            'POP\n')
+        assert open(out + '.pops').read() == 'a\nb\nc\n'
+        assert set(os.listdir('.')) == cwd_files
+
+
+def test_read_ped_chunks():
+    from genomics.popgen.plink import ped
+    with tempfile.TemporaryDirectory() as tmp:
+        pref, fams, snps, genotypes = _make_plink(tmp, nind=25, nsnps=6)
+        chunks = ped.get_chunks(pref + '.ped', 100)
+        assert len(chunks) > 2
+        data = open(pref + '.ped', 'rb').read()
+        assert all(data[end - 1:end] == b'\n' for start, end in chunks)
+        serial_fams, serial = ped.read_ped(pref, processes=1)
+        par_fams, par = ped.read_ped(pref, processes=2, chunk_bytes=100)
+        assert par_fams == serial_fams == fams
+        assert (par == serial).all()
+        assert serial.shape == (25, 12)
+
+
+_R2 = ''' CHR_A         BP_A        SNP_A  CHR_B         BP_B        SNP_B           R2
+     1         1000          rs1      1         2000          rs2     0.512
+     1         1000          rs1      1         3000          rs3        NA
+     2          500          rs4      2          900          rs5         1
+'''
+
+_HWE = ''' CHR   SNP     TEST   A1   A2                 GENO   O(HET)   E(HET)            P
+   1   rs1  ALL(NP)    A    G             1/20/79      0.2    0.255      0.1234
+   1   rs2  ALL(NP)    C    T              0/2/98     0.02  0.01980           1
+'''
+
+
+def test_parse_columnar():
+    from genomics.popgen.plink import parser
+    records = list(parser.parse_r2(io.StringIO(_R2)))
+    assert records[1]['R2'] is None
+    for chunk_size in [1, 100000]:
+        columns = parser.parse_r2(io.StringIO(_R2), columnar=True,
+                                  chunk_size=chunk_size)
+        assert columns['BP_B'].dtype == numpy.int64
+        assert columns['BP_B'].tolist() == [rec['BP_B'] for rec in records]
+        assert columns['SNP_A'].tolist() == ['rs1', 'rs1', 'rs4']
+        assert numpy.isnan(columns['R2'][1])
+        assert columns['R2'][[0, 2]].tolist() == [0.512, 1.0]
+    hwe = parser.parse_hwe(io.StringIO(_HWE), columnar=True)
+    assert hwe['GENO'].tolist() == [[1, 20, 79], [0, 2, 98]]
+    assert [rec['GENO'] for rec in parser.parse_hwe(io.StringIO(_HWE))] == \
+        hwe['GENO'].tolist()
+    empty = parser.parse_r2(io.StringIO(_R2.split('\n')[0]), columnar=True)
+    assert len(empty['R2']) == 0 and empty['CHR_A'].dtype == numpy.int64
+
+
+def test_parse_pushdown():
+    from genomics import GenomicsException
+    from genomics.popgen.plink import parser
+    where = {'R2': lambda x: x > 0.6}
+    records = list(parser.parse_r2(io.StringIO(_R2), fields=['SNP_B', 'R2'],
+                                   where=where))
+    assert records == [{'SNP_B': 'rs5', 'R2': 1.0}]
+    columns = parser.parse_r2(io.StringIO(_R2), columnar=True,
+                              fields=['SNP_B', 'R2'], where=where)
+    assert sorted(columns.keys()) == ['R2', 'SNP_B']
+    assert columns['SNP_B'].tolist() == ['rs5']
+    records = list(parser.parse_r2(io.StringIO(_R2),
+                                   where={'SNP_A': lambda x: x == 'rs1'}))
+    assert [rec['SNP_B'] for rec in records] == ['rs2', 'rs3']
+    hwe = parser.parse_hwe(io.StringIO(_HWE), columnar=True,
+                           fields=['SNP', 'GENO'],
+                           where={'P': lambda x: x < 0.5})
+    assert hwe['GENO'].tolist() == [[1, 20, 79]]
+    try:
+        list(parser.parse_r2(io.StringIO(_R2), fields=['R3']))
+        assert False
+    except GenomicsException:
+        pass
+
+
+def test_bim_index():
+    from genomics.popgen.plink import parser
+    with tempfile.TemporaryDirectory() as tmp:
+        bim = os.path.join(tmp, 'data.bim')
+        w = open(bim, 'w')
+        for i, (chro, pos) in enumerate([('1', 500), ('X', 100), ('1', 100),
+                                         ('2L', 300), ('1', 300),
+                                         ('X', 900)]):
+            w.write('%s\trs%d\t0\t%d\tA\tG\n' % (chro, i, pos))
+        w.close()
+        assert list(parser.get_snps(bim, lambda chro, pos:
+                                    chro in [1, 'X'] and pos < 400)) == \
+            ['rs1', 'rs2', 'rs4']
+        index = parser.get_bim_index(bim)
+        assert parser.get_bim_index(bim) is index
+        snps, indexes = index.query([(1, 100, 300), ('X', 100, 100),
+                                     ('1', 250, 600), ('3', 1, 1000)])
+        assert snps == ['rs0', 'rs1', 'rs2', 'rs4']
+        assert indexes.tolist() == [0, 1, 2, 4]
+        bed = os.path.join(tmp, 'regions.bed')
+        open(bed, 'w').write('track name=x\n2L\t299\t300\nX\t100\t1000\n')
+        assert index.query_bed(bed)[0] == ['rs3', 'rs5']
+        # Long (indel) alleles do not widen the index
+        w = open(bim, 'a')
+        w.write('X\trs6\t0\t950\t%s\tA\n' % ('AT' * 5000))
+        w.close()
+        index = parser.get_bim_index(bim)
+        assert index.query([('X', 901, 1000)])[0] == ['rs6']
+        assert index.snps.dtype == object
+
+
+def test_to_formats():
+    from genomics.popgen.plink import convert
+    pop_dict = {'p1': [('f0', 'i0'), ('f1', 'i3')], 'p2': [('f0', 'i2')]}
+    with tempfile.TemporaryDirectory() as tmp:
+        pref, fams, snps, genotypes = _make_plink(tmp)
+        single = os.path.join(tmp, 'single')
+        multi = os.path.join(tmp, 'multi')
+        convert.to_genepop(pref, single, pop_dict)
+        convert.to_ldhat(pref, single + '.sites', single + '.locs')
+        convert.to_formats(pref, gp_pref=multi, pop_dict=pop_dict,
+                           ld_sites=multi + '.sites', ld_locs=multi + '.locs',
+                           eigen_pref=multi, max_memory=0)
+        for ext in ['.gp', '.pops', '.sites', '.locs']:
+            assert open(single + ext).read() == open(multi + ext).read()
+        # Not recode12, the minor allele is counted (the largest on ties)
+        expected = []
+        for snp, counts in zip(snps, genotypes):
+            n1 = sum(count for count in counts if count >= 0)
+            n2 = sum(2 - count for count in counts if count >= 0)
+            a1_minor = n1 < n2 or (n1 == n2 and snp[4] > snp[5])
+            expected.append(''.join(
+                '9' if count < 0 else
+                '0' if n1 == 0 or n2 == 0 else
+                str(count if a1_minor else 2 - count) for count in counts))
+        assert open(multi + '.geno').read().split() == expected
+
+        for snp in snps:
+            snp[4:] = ['1', '2']
+        _write_plink(pref, fams, snps, genotypes)
+        convert.to_eigen(pref, single, packed=True)
+        convert.to_formats(pref, eigen_pref=multi, packed=True)
+        for ext in ['.geno', '.snp', '.ind']:
+            assert open(single + ext, 'rb').read() == \
+                open(multi + ext, 'rb').read()
+
+
+def test_to_formats_minor_allele():
+    from genomics.popgen.plink import convert
+    with tempfile.TemporaryDirectory() as tmp:
+        nind = 2000
+        fams = [['f', 'i%d' % i, '0', '0', '1', '-9'] for i in range(nind)]
+        # 1100 AA and 900 GG at rs0, skewed the other way at rs1
+        snps = [['1', 'rs0', '0', '1000', 'A', 'G'],
+                ['1', 'rs1', '0', '2000', 'C', 'T']]
+        genotypes = [[2] * 1100 + [0] * 900,
+                     [0] * 1500 + [1] * 300 + [-1] * 200]
+        pref = os.path.join(tmp, 'data')
+        _write_plink(pref, fams, snps, genotypes)
+        bed_pref = os.path.join(tmp, 'bed')
+        for ext in ['.bed', '.bim', '.fam']:
+            os.rename(pref + ext, bed_pref + ext)
+        out = os.path.join(tmp, 'out')
+        convert.to_formats(pref, eigen_pref=out)
+        geno = open(out + '.geno').read().split()
+        assert geno[0] == '0' * 1100 + '2' * 900
+        assert geno[1] == '0' * 1500 + '1' * 300 + '9' * 200
+        convert.to_formats(bed_pref, eigen_pref=out)
+        bed_geno = open(out + '.geno').read().split()
+        convert.to_eigen(bed_pref, out)
+        assert bed_geno == open(out + '.geno').read().split()
+        assert bed_geno[0] == '2' * 1100 + '0' * 900
+
+
+def test_multi_character_alleles():
+    from genomics import GenomicsException
+    from genomics.popgen.plink import convert, ped
+    fam, alleles = ped.parse_ped_line('f i1 0 0 1 -9\tA G  C\tC\n')
+    assert fam == ['f', 'i1', '0', '0', '1', '-9']
+    assert alleles.tobytes() == b'AGCC'
+    with tempfile.TemporaryDirectory() as tmp:
+        pref = os.path.join(tmp, 'data')
+        w = open(pref + '.ped', 'w')
+        w.write('f i1 0 0 1 -9 AT A C C\n')
+        w.close()
+        w = open(pref + '.map', 'w')
+        w.write('1 rs1 0 1000\n1 rs2 0 2000\n')
+        w.close()
+        for convert_call in [
+                lambda: convert.to_genepop(pref, pref, {'p': [('f', 'i1')]}),
+                lambda: convert.to_ldhat(pref, pref + '.sites',
+                                         pref + '.locs'),
+                lambda: ped.read_ped(pref)]:
+            try:
+                convert_call()
+                assert False
+            except GenomicsException:
+                pass
+
+
+def test_bed_multi_character_alleles():
+    from genomics import GenomicsException
+    from genomics.popgen.plink.bed import BedReader
+    with tempfile.TemporaryDirectory() as tmp:
+        pref = os.path.join(tmp, 'data')
+        w = open(pref + '.bim', 'w')
+        w.write('1\trs1\t0\t1000\tAT\tA\n')
+        w.close()
+        w = open(pref + '.fam', 'w')
+        w.write('f i1 0 0 1 -9\n')
+        w.close()
+        w = open(pref + '.bed', 'wb')
+        w.write(bytes([0x6c, 0x1b, 0x01, 0x02]))
+        w.close()
+        reader = BedReader(pref)
+        assert reader.get_alleles(recode12=True).tobytes() == b'12'
+        try:
+            reader.get_alleles()
+            assert False
+        except GenomicsException:
+            pass